@@ -0,0 +1,110 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+
+import anyio
+
+from bench import server, transport
+
+# Correctness checks of the fetch path against the local stand-in server, for cases the benchmark
+# scenarios do not run into on their own.
+
+
+# The cache entry is evicted between making the request conditional and the 304 arriving, as a
+# concurrent store can do. The page must still be fetched in full.
+async def evicted_before_not_modified(folder, send=None):
+    import sources
+    from sources import base, cache
+
+    class EvictingCache(cache.ResponseCache):
+        def prepare(self, request):
+            super().prepare(request)
+            self.max_size = 0
+            self.evict()
+
+    fetcher = sources.Base.sources["syosetu"]("n1000aa")
+    if send is not None:
+        client = fetcher.client
+        fetcher.client = lambda url: send(client(url))
+    url = "https://ncode.syosetu.com/n1000aa/"
+    original = base.response_cache
+    base.response_cache = EvictingCache(f"{folder}/http_cache.db")
+    try:
+        async with sources.Scheduler() as scheduler:
+            fetcher.scheduler = scheduler
+            fetcher.limiter = scheduler.limiter(fetcher)
+            first = await fetcher.get_retry(url, cache=True)
+            base.response_cache.max_size = 64 * 1024 * 1024
+            base.response_cache.store(first)
+            second = await fetcher.get_retry(url, cache=True)
+    finally:
+        base.response_cache.close()
+        base.response_cache = original
+    assert second.status_code == 200 and second.content == first.content, "page not fetched after eviction"
+
+
+# As above, with the full request sent after the 304 timing out once. It must be retried like any
+# other attempt.
+async def timeout_after_evicted_not_modified(folder):
+    import httpx
+
+    class Client:
+        modified = True
+        timed_out = False
+
+        def __init__(self, client):
+            self.client = client
+
+        def __getattr__(self, name):
+            return getattr(self.client, name)
+
+        async def send(self, request):
+            if not Client.modified and not Client.timed_out:
+                Client.timed_out = True
+                raise httpx.ReadTimeout("bench timeout", request=request)
+            response = await self.client.send(request)
+            Client.modified = response.status_code != httpx.codes.NOT_MODIFIED
+            return response
+
+    await evicted_before_not_modified(folder, Client)
+    assert Client.timed_out, "request after the 304 not sent"
+
+
+checks = {
+    "evicted-before-304": evicted_before_not_modified,
+    "timeout-after-evicted-304": timeout_after_evicted_not_modified,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run fetch correctness checks against the local stand-in server")
+    parser.add_argument("checks", nargs="*", help=f"some of {', '.join(checks)}, all by default")
+    args = parser.parse_args()
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), server.Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as folder:
+        # The novel database is opened in the working directory
+        os.chdir(folder)
+        transport.install(f"http://127.0.0.1:{httpd.server_address[1]}")
+        import main as console
+        console.handle_once(["init"], None)
+        for name in args.checks or checks:
+            try:
+                anyio.run(checks[name], folder)
+                print(f"{name}: ok")
+            except Exception as e:
+                failed += 1
+                print(f"{name}: failed, {e.__class__.__name__} {e}")
+    httpd.shutdown()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import pathlib
+import sys
+import time
+
+from bench import server
+
+# Golden corpus of episode pages and the HTML the sources store for them. The expected output was
+# produced once by the BeautifulSoup parsers in bench.reference, `python -m bench.golden` checks the
+# current parsers still match it byte for byte and compares their speed.
+
+folder = pathlib.Path(__file__).resolve().parent / "golden"
+
+syosetu_page = """<!DOCTYPE html>
+<html lang="ja">
+<head><meta charset="UTF-8"><title>テスト</title></head>
+<body>
+<div class="p-novel__body">
+  <div class="js-novel-text p-novel__text p-novel__text--preface">
+    <p id="Lp1">前書きです。</p>
+    <p id="Lp2"><br /></p>
+  </div>
+  <div class="js-novel-text p-novel__text">
+    <p id="L1">　彼は<ruby><rb>扉</rb><rp>(</rp><rt>とびら</rt><rp>)</rp></ruby>を開けた。</p>
+    <p id="L2"><br /></p>
+    <p id="L3"></p>
+    <p id="L4"> </p>
+    <p id="L5">「<ruby>傍点<rt>・・</rt></ruby>」と<ruby><rb>強</rb><rp>（</rp><rt>・</rt><rp>）</rp></ruby>調</p>
+    <p id="L6"><ruby> 空白 <!-- 注 --><rt>・・</rt></ruby><ruby>読み無し</ruby><ruby>混在<rt>・あ</rt></ruby></p>
+    <p id="L7">&lt;タグ&gt; &amp; 記号 &gt; &#12288;全角&#x3000;空白 &quot;引用&quot; 'single'</p>
+    <p id="L8"><a href="https://example.com/?a=1&amp;b=2" title='say "hi"'><img src="/i.png" alt="it's &quot;both&quot;" /></a></p>
+    <p id="L9" class="  spaced   class "><span>入れ子</span>  <span>要素</span>
+    </p>
+    <p id="L10"><!-- コメント --><br /><br /></p>
+    <p id="L11"><br />	</p>
+    <p id="L12"><![CDATA[<cdata> & text]]></p>
+    <p>id無し 😀</p>
+  </div>
+  <div class="js-novel-text p-novel__text p-novel__text--afterword">
+    <p id="La1">後書きです。</p>
+  </div>
+</div>
+</body>
+</html>
+"""
+
+kakuyomu_body = """<p id="p1">　彼は<ruby><rb>扉</rb><rp>(</rp><rt>とびら</rt><rp>)</rp></ruby>を開けた。</p>
+<p id="p2" class="blank"><br></p>
+<p id="p3"><em class="emphasisDots"><span>傍</span><span>点</span></em>と<em class="  emphasisDots  extra ">  空白  </em></p>
+<p id="p4"><em class="emphasisDots"><ruby>強<rt>つよ</rt></ruby>調<!-- 注 --></em></p>
+<p id="p5"><ruby>傍点<rt>・・</rt></ruby><ruby>読み無し</ruby></p>
+<p id="p6">&lt;タグ&gt; &amp; 記号 &nbsp;&quot;引用&quot; <a href="/x?a=1&amp;b=2" rel=" nofollow  noopener" title='say "hi"'>リンク</a></p>
+<p id="p7"><img src="/i.png" alt="it's &quot;both&quot;"><span class="a
+b">改行</span>  <span>要素</span></p>
+<p id="p8"></p>
+<pre>  整形済み  </pre>
+"""
+
+alphapolis_page = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>テスト</title></head>
+<body>
+<div class="text" id="novelBody">
+　彼は<ruby>扉<rt>とびら</rt></ruby>を開けた。<br>
+「<ruby>傍点<rt>・・</rt></ruby>」<br>
+<br>
+<br>
+<span class="a  b">装飾</span>の後<br />
+<!-- 広告 -->
+&lt;タグ&gt; &amp; 記号 &nbsp;<a href="/x?a=1&amp;b=2">リンク</a><br>
+   <br>
+最後の行
+</div>
+</body>
+</html>
+"""
+
+
+def cases():
+    server.config.update(paragraphs=60)
+    yield "syosetu", "page", syosetu_page.encode()
+    yield "syosetu", "bom", b"\xef\xbb\xbf" + syosetu_page.encode()
+    yield "syosetu", "shift-jis", ('<?xml version="1.0" encoding="Shift_JIS"?>\n'
+                                   + syosetu_page.replace(" 😀", "")).encode("shift_jis")
+    yield "syosetu", "crlf", syosetu_page.replace("\n", "\r\n").encode()
+    yield "syosetu", "xhtml", syosetu_page.replace('<html lang="ja">', '<html xmlns="http://www.w3.org/1999/xhtml">').encode()
+    yield "syosetu", "empty", b'<html><body><div class="p-novel__text"></div></body></html>'
+    yield "kakuyomu", "body", kakuyomu_body.encode()
+    yield "kakuyomu", "leading-text", ('前置き' + kakuyomu_body).encode()
+    yield "alphapolis", "page", alphapolis_page.encode()
+    yield "alphapolis", "shift-jis", alphapolis_page.replace("utf-8", "shift_jis").encode("shift_jis")
+    yield "alphapolis", "no-breaks", '<html><body><div id="novelBody">一行だけ</div></body></html>'.encode()
+    yield "alphapolis", "only-breaks", '<html><body><div id="novelBody"><br><br>\n<br></div></body></html>'.encode()
+    for n in range(4):
+        yield "syosetu", f"bench-{n}", server.syosetu_episode("n1000aa", n).encode()
+        body = server.kakuyomu_graphql({"operationName": "GetEpisodes", "variables": {"e0": f"1000000000{n:08}"}})
+        yield "kakuyomu", f"bench-{n}", body["json"]["data"]["e0"]["bodyHTML"].encode()
+        yield "alphapolis", f"bench-{n}", server.alphapolis_episode("100000000/200000000", str(1000 + n)).encode()
+
+
+def load(source: str, raw: bytes):
+    # Kakuyomu hands the parser the str of the GraphQL response
+    return raw.decode() if source == "kakuyomu" else raw
+
+
+def generate():
+    from bench import reference
+
+    for source, name, raw in cases():
+        path = folder / source
+        path.mkdir(parents=True, exist_ok=True)
+        (path / f"{name}.in").write_bytes(raw)
+        (path / f"{name}.out").write_bytes(reference.parsers[source](load(source, raw)).encode())
+        print(f"{source}/{name}")
+
+
+def timing(parse, corpus, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for raw in corpus:
+            parse(raw)
+    return time.perf_counter() - started
+
+
+def check(rounds):
+    import sources
+    from bench import reference
+
+    failed = 0
+    for path in sorted(folder.iterdir()):
+        source = sources.Base.sources[path.name]
+        corpus = []
+        for case in sorted(path.glob("*.in")):
+            raw = load(path.name, case.read_bytes())
+            expected = case.with_suffix(".out").read_bytes().decode()
+            actual = source.parse_episode(raw)
+            corpus.append(raw)
+            if actual != expected:
+                failed += 1
+                at = next((i for i, (a, b) in enumerate(zip(actual, expected)) if a != b),
+                          min(len(actual), len(expected)))
+                print(f"{path.name}/{case.stem}: differs at {at}\n"
+                      f"  expected {expected[max(0, at - 40):at + 40]!r}\n"
+                      f"  actual   {actual[max(0, at - 40):at + 40]!r}")
+        if rounds:
+            before = timing(reference.parsers[path.name], corpus, rounds)
+            after = timing(source.parse_episode, corpus, rounds)
+            print(f"{path.name:<12}{len(corpus):>4} cases  reference {before / rounds * 1000:8.2f}ms  "
+                  f"current {after / rounds * 1000:8.2f}ms  {before / after:5.1f}x")
+    print("golden corpus matches" if not failed else f"{failed} cases differ")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check episode parsing against the golden corpus")
+    parser.add_argument("--generate", action="store_true",
+                        help="rewrite the corpus from bench.reference, only when the stored format changes on purpose")
+    parser.add_argument("--rounds", type=int, default=20, help="timing rounds over the corpus, 0 to skip")
+    args = parser.parse_args()
+    if args.generate:
+        generate()
+    else:
+        sys.exit(1 if check(args.rounds) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import time
+
+from bench import reference, server
+
+# Times episode parsing on chapters of growing length, the BeautifulSoup parsers in bench.reference
+# against the current ones. Parsing the page alone is reported separately to show what the rewrite
+# on top of it costs.
+
+
+def chapter(source: str, paragraphs: int):
+    server.config.update(paragraphs=paragraphs)
+    if source == "syosetu":
+        return server.syosetu_episode("n1000aa", 1).encode()
+    if source == "kakuyomu":
+        body = server.kakuyomu_graphql({"operationName": "GetEpisodes", "variables": {"e0": "100000000000000001"}})
+        return body["json"]["data"]["e0"]["bodyHTML"]
+    return server.alphapolis_episode("100000000/200000000", "1001").encode()
+
+
+def best(function, raw, rounds):
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        function(raw)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def main():
+    import sources
+    from sources import markup
+
+    parser = argparse.ArgumentParser(description="Time episode parsing on long chapters")
+    parser.add_argument("sources", nargs="*", help=f"some of {', '.join(reference.parsers)}, alphapolis by default")
+    parser.add_argument("--paragraphs", type=int, nargs="+", default=[100, 1000, 5000, 20000])
+    parser.add_argument("--rounds", type=int, default=5, help="the best of these is reported")
+    args = parser.parse_args()
+
+    print(f"{'source':<12}{'paragraphs':>11}{'KiB':>8}{'reference ms':>14}{'current ms':>12}{'parse only ms':>15}"
+          f"{'speedup':>9}")
+    for name in args.sources or ["alphapolis"]:
+        source = sources.Base.sources[name]
+        for paragraphs in args.paragraphs:
+            raw = chapter(name, paragraphs)
+            if reference.parsers[name](raw) != source.parse_episode(raw):
+                raise RuntimeError(f"{name} output differs from the reference at {paragraphs} paragraphs")
+            before = best(reference.parsers[name], raw, args.rounds)
+            after = best(source.parse_episode, raw, args.rounds)
+            parse = best(lambda raw: markup.parse(raw, html=name != "syosetu"), raw, args.rounds)
+            print(f"{name:<12}{paragraphs:>11}{len(raw) / 1024:>8.0f}{before * 1000:>14.2f}{after * 1000:>12.2f}"
+                  f"{parse * 1000:>15.2f}{before / after:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import copy
+
+from bs4 import BeautifulSoup, NavigableString, Tag
+
+# The BeautifulSoup episode parsers the sources used before moving to lxml, kept as they were to
+# generate the golden corpus (bench.golden) and to compare parsing speed against.
+
+zygote = BeautifulSoup('<p></p>', 'lxml').find('p')
+
+
+def make_tag(name):
+    tag = copy.copy(zygote)
+    tag.name = name
+    return tag
+
+
+def normalize_ruby_emphasis(content: Tag):
+    for em_ruby in content.select('ruby'):
+        rts = em_ruby.select('rt')
+        if not all(all(char == '・' for char in rt.text) for rt in rts):
+            continue
+
+        base = ''.join(part.strip() for part in em_ruby if isinstance(part, NavigableString))
+        em_ruby.attrs = {'class': 'dot'}
+        em_ruby.name = 'em'
+        em_ruby.clear(True)
+        em_ruby.append(NavigableString(base))
+
+
+def syosetu(raw):
+    content = BeautifulSoup(raw, "lxml-xml")
+    contents = content.select(".p-novel__text")
+    if not contents:
+        raise RuntimeError("Can't find content")
+    content = contents[0]
+    for extra in contents[1:]:
+        separator = make_tag('p')
+        separator.attrs = {'class': 'split'}
+        separator.append(make_tag('hr'))
+        content.append(separator)
+        content.extend(extra)
+
+    content.attrs = {'class': 'content'}
+
+    # clean id on <p> and mark blank element
+    for p in content.select('p'):
+        if 'id' in p.attrs:
+            del p.attrs['id']
+        if all(isinstance(t, Tag) and t.name == 'br' for t in p):
+            p.attrs['class'] = 'blank'
+
+    normalize_ruby_emphasis(content)
+
+    content = content.decode()
+    return content
+
+
+def kakuyomu(raw):
+    content = BeautifulSoup(raw, 'lxml')
+    content = content.select_one("body")
+    content.name = 'div'
+    content.attrs = {'class': 'content'}
+
+    # clean id on <p>
+    for p in content.select('p'):
+        del p.attrs['id']
+
+    # normalize emphasis
+    for em in content.select('em.emphasisDots'):
+        em.attrs = {'class': 'dot'}
+        text = NavigableString(em.text.strip())
+        em.clear(True)
+        em.append(text)
+
+    normalize_ruby_emphasis(content)
+
+    content = content.decode()
+    return content
+
+
+def alphapolis(raw):
+    content = BeautifulSoup(raw, "lxml")
+    content = content.select_one("#novelBody")
+    content.attrs = {'class': 'content'}
+
+    # Rewrite to p-based formatting
+    contents = []
+    line = copy.copy(zygote)
+    all_br = True
+    for el in list(content):
+        el = el.extract()
+        if isinstance(el, NavigableString) and not el.strip():
+            continue
+        if isinstance(el, Tag) and el.name == 'br':
+            if all_br:
+                line.append(el)
+            else:
+                contents.append(line)
+                line = copy.copy(zygote)
+                all_br = True
+        else:
+            if all_br and line.contents:
+                line.attrs['class'] = 'blank'
+                contents.append(line)
+                line = copy.copy(zygote)
+            if isinstance(el, NavigableString):
+                el = NavigableString(el.removeprefix('\n'))
+            all_br = False
+            line.append(el)
+    if all_br:
+        line.attrs['class'] = 'blank'
+    if line.contents:
+        contents.append(line)
+
+    newlines = [NavigableString('\n') for _ in range(len(contents))]
+    contents = [i for pair in zip(contents, newlines) for i in pair]
+    content.clear(True)
+    content.extend(contents)
+
+    normalize_ruby_emphasis(content)
+
+    content = content.decode()
+    return content
+
+
+parsers = {
+    "syosetu": syosetu,
+    "kakuyomu": kakuyomu,
+    "alphapolis": alphapolis,
+}
@@ -0,0 +1,200 @@
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+root = pathlib.Path(__file__).resolve().parent.parent
+
+
+@dataclass
+class Scenario:
+    # Commands run before measuring, and the measured ones
+    setup: List[str]
+    measure: List[str]
+    # What the measured commands processed, counted in the database afterwards
+    count: str
+    # Server config applied between setup and measure, "+" prefixed numbers are added
+    change: Dict[str, str] = field(default_factory=dict)
+
+
+syosetu_book = "syosetu:n1000aa"
+books = [syosetu_book, "kakuyomu:100000000000000000", "alphapolis:100000000/200000000",
+         "syosetu:n1001aa", "kakuyomu:100000000000000001", "alphapolis:100000001/200000001"]
+new_rows = "SELECT count(*) FROM episode WHERE id > (SELECT coalesce(max(id), 0) FROM bench_before)"
+latest_rows = "SELECT count(*) FROM episode WHERE latest == TRUE"
+ruby_rows = "SELECT count(*) FROM episode_ruby"
+
+
+def scenarios(args) -> Dict[str, Scenario]:
+    many = books[:args.books] if args.books <= len(books) else books
+    return {
+        "fetch-syosetu": Scenario([], [f"fetch {syosetu_book}"], new_rows),
+        "fetch-kakuyomu": Scenario([], [f"fetch {books[1]}"], new_rows),
+        "fetch-alphapolis": Scenario([], [f"fetch {books[2]}"], new_rows),
+        "update": Scenario([f"fetch {book}" for book in many], ["update"], new_rows,
+                           {"revision": "+1", "episodes": f"+{max(1, args.episodes // 10)}"}),
+        "ruby": Scenario([f"fetch {syosetu_book}"], [f"ruby {syosetu_book} --jobs={args.jobs}"], ruby_rows),
+        "epub": Scenario([f"fetch {syosetu_book}"], [f"epub {syosetu_book}"], latest_rows),
+        "tex": Scenario([f"fetch {syosetu_book}"], [f"tex {syosetu_book}"], latest_rows),
+    }
+
+
+def control(server, change=None):
+    request = urllib.request.Request(server + "/config", data=None if change is None else json.dumps(change).encode(),
+                                     headers={"X-Bench-Host": "control"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+# Runs in a fresh process inside the work directory, so peak RSS only covers the phase itself
+def run_phase(scenario: Scenario, phase: str, server: str, http2=True):
+    from bench import transport
+    transport.install(server, http2)
+    import main
+
+    commands = scenario.setup if phase == "setup" else scenario.measure
+    with open("bench.log", "a") as log, contextlib.redirect_stdout(log):
+        if phase == "setup":
+            main.handle_once(["init"], None)
+        db = sqlite3.connect("novel.db")
+        db.execute("CREATE TABLE IF NOT EXISTS bench_before(id INTEGER)")
+        db.execute("DELETE FROM bench_before")
+        db.execute("INSERT INTO bench_before SELECT max(id) FROM episode")
+        db.commit()
+
+        started = time.perf_counter()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        for command in commands:
+            main.handle_once(command.split(), None)
+        elapsed = time.perf_counter() - started
+
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    count = db.execute(scenario.count).fetchone()[0]
+    latencies = sorted(transport.latencies)
+    print(json.dumps({
+        "elapsed": elapsed,
+        "episodes": count,
+        "episodes_per_s": count / elapsed if elapsed else 0.0,
+        "requests": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "cpu_s": end.ru_utime + end.ru_stime - usage.ru_utime - usage.ru_stime,
+        "cpu_children_s": children.ru_utime + children.ru_stime,
+        "peak_rss_mb": end.ru_maxrss / 1024,
+        "peak_rss_children_mb": children.ru_maxrss / 1024,
+    }))
+
+
+def spawn_phase(name, phase, server, workdir, args):
+    env = os.environ | {"PYTHONPATH": str(root)}
+    result = subprocess.run([sys.executable, "-m", "bench.run", name, "--phase", phase, "--server", server,
+                             "--episodes", str(args.episodes), "--books", str(args.books), "--jobs", str(args.jobs)]
+                            + (["--http1"] if args.http1 else []),
+                            cwd=workdir, env=env, stdout=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{name} {phase} failed, see {workdir}/bench.log")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_scenario(name, scenario: Scenario, server, args):
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    for dictionary in ("episode.dict", "episode_ruby.dict"):
+        shutil.copy(root / dictionary, workdir)
+
+    control(server, {"revision": 0, "episodes": args.episodes, "latency": 0, "errors": 0})
+    spawn_phase(name, "setup", server, workdir, args)
+
+    config = control(server)["config"]
+    change = {key: config[key] + float(value) if value.startswith("+") else float(value)
+              for key, value in scenario.change.items()}
+    change = {key: int(value) if isinstance(config[key], int) else value for key, value in change.items()}
+    control(server, change | {"latency": args.latency, "errors": args.errors})
+    requests = control(server)["stats"]["requests"]
+
+    metrics = spawn_phase(name, "measure", server, workdir, args)
+    metrics["server_requests"] = control(server)["stats"]["requests"] - requests
+    if not args.keep:
+        shutil.rmtree(workdir)
+    return metrics
+
+
+def report(results):
+    columns = ["elapsed", "episodes", "episodes_per_s", "requests", "p50_ms", "p99_ms", "cpu_s", "cpu_children_s",
+               "peak_rss_mb"]
+    print(f"{'scenario':<18}" + "".join(f"{column:>16}" for column in columns))
+    for name, metrics in results.items():
+        cells = []
+        for column in columns:
+            value = metrics[column]
+            cells.append(f"{value:>16.2f}" if isinstance(value, float) else f"{value:>16}")
+        print(f"{name:<18}" + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks against a local stand-in for the novel sites")
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run, all by default")
+    parser.add_argument("--episodes", type=int, default=300, help="episodes per book")
+    parser.add_argument("--books", type=int, default=6, help="books in the update scenario")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes of the ruby scenario")
+    parser.add_argument("--latency", type=float, default=0.0, help="server latency per request in seconds")
+    parser.add_argument("--errors", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--http1", action="store_true", help="talk HTTP/1.1 to the server instead of h2c")
+    parser.add_argument("--output", help="append results as JSON lines to this file")
+    parser.add_argument("--keep", action="store_true", help="keep work directories")
+    parser.add_argument("--phase", help=argparse.SUPPRESS)
+    parser.add_argument("--server", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    available = scenarios(args)
+    names = args.scenarios or list(available)
+    for name in names:
+        if name not in available:
+            parser.error(f"unknown scenario {name}, choose from {', '.join(available)}")
+
+    if args.phase is not None:
+        run_phase(available[names[0]], args.phase, args.server, not args.http1)
+        return
+
+    server = subprocess.Popen([sys.executable, "-m", "bench.server"], cwd=root, stdout=subprocess.PIPE, text=True)
+    try:
+        url = f"http://127.0.0.1:{server.stdout.readline().strip()}"
+        results = {}
+        for name in names:
+            results[name] = run_scenario(name, available[name], url, args)
+            print(f"{name}: {results[name]['elapsed']:.2f}s", file=sys.stderr)
+    finally:
+        server.terminate()
+        server.wait()
+
+    report(results)
+    if args.output:
+        with open(args.output, "a") as output:
+            for name, metrics in results.items():
+                output.write(json.dumps({"scenario": name, "time": time.time(), "episodes_per_book": args.episodes,
+                                         "latency": args.latency, "errors": args.errors,
+                                         "http2": not args.http1} | metrics) + "\n")
+
+
+if __name__ == '__main__':
+    main()
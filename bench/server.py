@@ -0,0 +1,363 @@
+import argparse
+import hashlib
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+
+# Stand-in for the novel sites. Requests arrive with their original host in the X-Bench-Host header
+# (see bench.transport) and get synthetic pages in the markup the sources parse. Every book has the
+# configured number of episodes, all versions derive from the revision number, and the config can be
+# changed while running by POSTing JSON to /config on the control host.
+# Connections starting with the HTTP/2 preface are served as h2c with prior knowledge, which is how
+# bench.transport talks to it unless asked for HTTP/1.1, the others as HTTP/1.1.
+
+sentences = [
+    "彼は静かに扉を開けて、薄暗い廊下へと足を踏み出した。",
+    "「本当に行くつもりなの？」と彼女は不安そうに尋ねた。",
+    "遠くの山々は朝焼けに染まり、村には穏やかな時間が流れていた。",
+    "魔法の研究を続けるには、王立図書館の禁書庫に入る許可が必要だった。",
+    "騎士団長は剣を抜き、迫りくる魔物の群れを睨みつけた。",
+    "冒険者ギルドの掲示板には、新しい依頼が何枚も貼り出されている。",
+    "東京の大学に通っていた頃の記憶が、ふと頭をよぎった。",
+    "彼女の瞳には、決して消えることのない強い意志が宿っていた。",
+]
+
+config = {
+    "episodes": 100,
+    "paragraphs": 60,
+    "latency": 0.0,
+    "errors": 0.0,
+    "revision": 0,
+    # Revise before the last episode is posted, so the novel API shows no update after it
+    "revised_before_last": False,
+}
+lock = threading.Lock()
+stats = {"requests": 0, "errors": 0, "not_modified": 0}
+
+epoch = datetime(2024, 1, 1, 9, 0)
+
+
+def episode_date(index, revision=0):
+    return epoch + timedelta(days=index, hours=revision)
+
+
+def paragraphs(key: str):
+    rng = random.Random(key)
+    lines = []
+    for i in range(config["paragraphs"]):
+        roll = rng.random()
+        if roll < 0.15:
+            lines.append(None)
+        elif roll < 0.25:
+            lines.append("<ruby>強調<rt>・・</rt></ruby>" + rng.choice(sentences))
+        elif roll < 0.35:
+            lines.append("<ruby>漢字<rp>(</rp><rt>かんじ</rt><rp>)</rp></ruby>" + rng.choice(sentences))
+        else:
+            lines.append("".join(rng.choice(sentences) for _ in range(rng.randint(1, 3))))
+    return lines
+
+
+def revised(index):
+    # Every tenth episode is revised with each revision of the book
+    return config["revision"] if index % 10 == 0 else 0
+
+
+# syosetu
+
+def syosetu_toc(book, page, per_page=100):
+    count = config["episodes"]
+    pages = max(1, (count + per_page - 1) // per_page)
+    items = []
+    for i in range((page - 1) * per_page, min(count, page * per_page)):
+        if i % 25 == 0:
+            items.append(f'<div class="p-eplist__chapter-title">第{i // 25 + 1}章</div>')
+        created = episode_date(i).strftime('%Y/%m/%d %H:%M')
+        updated = episode_date(i, revised(i)).strftime('%Y/%m/%d %H:%M')
+        mark = f'<span title="{updated} 改稿">（<u>改</u>）</span>' if revised(i) else ''
+        items.append(f'<div class="p-eplist__sublist">'
+                     f'<a href="/{book}/{i + 1}/" class="p-eplist__subtitle">第{i + 1}話 旅立ち</a>'
+                     f'<div class="p-eplist__update">{created}{mark}</div></div>')
+    pager = ''
+    if pages > 1:
+        pager = (f'<div class="c-pager__pager">'
+                 f'<a href="/{book}/?p={pages}" class="c-pager__item c-pager__item--last">最後へ</a></div>')
+    return (f'<html><head><title>ベンチマーク小説 {book}</title>'
+            f'<meta name="twitter:creator" content="作者"/></head><body>'
+            f'<div id="novel_ex">あらすじ</div><div class="p-eplist">{"".join(items)}</div>{pager}</body></html>')
+
+
+def syosetu_episode(book, index):
+    body = []
+    for n, line in enumerate(paragraphs(f"{book}/{index}/{revised(index)}")):
+        body.append(f'<p id="L{n + 1}">{"<br />" if line is None else line}</p>')
+    return ('<html><body><div class="p-novel__body">'
+            f'<div class="js-novel-text p-novel__text p-novel__text--preface"><p id="Lp1">前書き</p></div>'
+            f'<div class="js-novel-text p-novel__text">{"".join(body)}</div>'
+            '</div></body></html>')
+
+
+def syosetu_api(path):
+    if "novel18" in path:
+        return {"json": [{"allcount": 0}]}
+    count = config["episodes"]
+    # Revisions are made after the last episode was posted, unless revised_before_last
+    posted = episode_date(count - 1)
+    updated = posted if config["revised_before_last"] else episode_date(count - 1, config["revision"])
+    return {"json": [{"allcount": 1}, {"novelupdated_at": updated.strftime('%Y-%m-%d %H:%M:%S'),
+                                       "general_lastup": posted.strftime('%Y-%m-%d %H:%M:%S'),
+                                       "general_all_no": count}]}
+
+
+# kakuyomu
+
+def kakuyomu_graphql(body):
+    if body["operationName"] == "GetWorkPage":
+        work = body["variables"]["workId"]
+        toc = []
+        for start in range(0, config["episodes"], 25):
+            episodes = [{"id": f"{work[:10]}{i:08}",
+                         "title": f"第{i + 1}話",
+                         "publishedAt": episode_date(i).isoformat() + "Z",
+                         "editedAt": episode_date(i, revised(i)).isoformat() + "Z"}
+                        for i in range(start, min(config["episodes"], start + 25))]
+            toc.append({"chapter": {"id": f"c{start}", "title": f"第{start // 25 + 1}章", "level": 1},
+                        "episodeUnions": episodes})
+        return {"json": {"data": {"work": {"title": f"ベンチマーク {work}", "catchphrase": "キャッチコピー",
+                                           "introduction": "紹介文", "author": {"activityName": "作者"},
+                                           "tableOfContents": toc}}}}
+
+    episodes = {}
+    for alias, episode_id in body["variables"].items():
+        index = int(episode_id[-8:])
+        lines = paragraphs(f"{episode_id}/{revised(index)}")
+        html = "".join(f'<p id="p{n + 1}">{"<br />" if line is None else line}</p>'
+                       for n, line in enumerate(lines))
+        episodes[alias] = {"id": episode_id, "bodyHTML": html}
+    return {"json": {"data": episodes}}
+
+
+# alphapolis
+
+def alphapolis_index(book):
+    items = []
+    for i in range(config["episodes"]):
+        if i % 25 == 0:
+            items.append(f'<h3>第{i // 25 + 1}章</h3>')
+        date = episode_date(i, revised(i)).strftime('%Y.%m.%d %H:%M')
+        items.append(f'<div class="episode"><a href="/novel/{book}/episode/{1000 + i}">'
+                     f'<span class="title">第{i + 1}話</span><span class="open-date">{date}</span></a></div>')
+    return (f'<html><body><h1 class="title">ベンチマーク {book}</h1><div class="author"><a>作者</a></div>'
+            f'<div class="abstract">紹介文</div><div class="episodes">{"".join(items)}</div></body></html>')
+
+
+def alphapolis_episode(book, episode):
+    index = int(episode) - 1000
+    body = []
+    for line in paragraphs(f"{book}/{episode}/{revised(index)}"):
+        body.append("<br>" if line is None else f"\n{line}<br>")
+    return f'<html><body><div id="novelBody">{"".join(body)}</div></body></html>'
+
+
+def route(host, method, path, query, body):
+    parts = [part for part in path.split('/') if part]
+    if host == "api.syosetu.com":
+        return syosetu_api(path)
+    if host.endswith("syosetu.com"):
+        if len(parts) == 1:
+            return {"text": syosetu_toc(parts[0], int(query.get("p", ["1"])[0])), "cache": True}
+        return {"text": syosetu_episode(parts[0], int(parts[1]) - 1)}
+    if host == "kakuyomu.jp" and method == "POST":
+        return kakuyomu_graphql(json.loads(body))
+    if host == "www.alphapolis.co.jp":
+        if len(parts) == 3:
+            return {"text": alphapolis_index(f"{parts[1]}/{parts[2]}"), "cache": True}
+        return {"text": alphapolis_episode(f"{parts[1]}/{parts[2]}", parts[4])}
+    return None
+
+
+# Status, content type, extra headers and body of the response, for either protocol
+def respond(method, target, host, if_none_match, body):
+    html = "text/html; charset=utf-8"
+    url = urlsplit(target)
+
+    if host == "control":
+        with lock:
+            if method == "POST":
+                config.update(json.loads(body))
+            result = {"config": config, "stats": stats}
+        return 200, "application/json", {}, json.dumps(result).encode()
+
+    with lock:
+        stats["requests"] += 1
+        latency, errors = config["latency"], config["errors"]
+        failed = random.random() < errors
+        if failed:
+            stats["errors"] += 1
+    if latency:
+        time.sleep(latency)
+    if failed:
+        return 503, html, {"Retry-After": "0"}, b""
+
+    result = route(host, method, url.path, parse_qs(url.query), body)
+    if result is None:
+        return 404, html, {}, b""
+    if "json" in result:
+        return 200, "application/json", {}, json.dumps(result["json"]).encode()
+
+    content = result["text"].encode()
+    headers = {}
+    if result.get("cache"):
+        etag = '"' + hashlib.blake2b(content, digest_size=8).hexdigest() + '"'
+        headers["ETag"] = etag
+        if if_none_match == etag:
+            with lock:
+                stats["not_modified"] += 1
+            return 304, html, headers, b""
+    return 200, html, headers, content
+
+
+preface = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+
+# One h2c connection. Frames are read on the connection thread, each request is answered on a
+# thread of its own so latency applies per stream like on a multiplexed server.
+class H2Connection:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False,
+                                                                         header_encoding="utf-8"))
+        # Guards the connection state and the socket, and is signalled when flow control opens up
+        self.lock = threading.Condition()
+        self.requests = {}
+        self.closed = False
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def serve(self):
+        with self.lock:
+            self.conn.initiate_connection()
+            self.flush()
+        try:
+            while data := self.sock.recv(65536):
+                with self.lock:
+                    for event in self.conn.receive_data(data):
+                        self.event(event)
+                    self.flush()
+        except (OSError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            with self.lock:
+                self.closed = True
+                self.lock.notify_all()
+
+    def event(self, event):
+        if isinstance(event, h2.events.RequestReceived):
+            self.requests[event.stream_id] = (dict(event.headers), bytearray())
+        elif isinstance(event, h2.events.DataReceived):
+            self.requests[event.stream_id][1].extend(event.data)
+            self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            headers, body = self.requests.pop(event.stream_id)
+            threading.Thread(target=self.answer, args=(event.stream_id, headers, bytes(body)), daemon=True).start()
+        elif isinstance(event, h2.events.StreamReset):
+            self.requests.pop(event.stream_id, None)
+        elif isinstance(event, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged)):
+            self.lock.notify_all()
+
+    def answer(self, stream_id, headers, body):
+        status, content_type, extra, content = respond(headers[":method"], headers[":path"],
+                                                       headers.get("x-bench-host", ""),
+                                                       headers.get("if-none-match"), body)
+        response = [(":status", str(status)), ("content-type", content_type), ("content-length", str(len(content)))]
+        response.extend((name.lower(), value) for name, value in extra.items())
+        view = memoryview(content)
+        with self.lock:
+            try:
+                self.conn.send_headers(stream_id, response, end_stream=not view)
+                self.flush()
+                while view and not self.closed:
+                    size = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size,
+                               len(view))
+                    if size <= 0:
+                        self.lock.wait()
+                        continue
+                    self.conn.send_data(stream_id, bytes(view[:size]), end_stream=size == len(view))
+                    view = view[size:]
+                    self.flush()
+            except (OSError, h2.exceptions.StreamClosedError):
+                pass
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        try:
+            start = self.connection.recv(len(preface), socket.MSG_PEEK | socket.MSG_WAITALL)
+        except OSError:
+            return
+        if start == preface:
+            H2Connection(self.connection).serve()
+        else:
+            super().handle()
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self, method):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status, content_type, headers, content = respond(method, self.path, self.headers.get("X-Bench-Host", ""),
+                                                         self.headers.get("If-None-Match"), body)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the novel sites")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--episodes", type=int, default=config["episodes"])
+    parser.add_argument("--paragraphs", type=int, default=config["paragraphs"])
+    parser.add_argument("--latency", type=float, default=config["latency"], help="seconds per request")
+    parser.add_argument("--errors", type=float, default=config["errors"], help="share of 503 responses")
+    args = parser.parse_args()
+    config.update(episodes=args.episodes, paragraphs=args.paragraphs, latency=args.latency, errors=args.errors)
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    server.daemon_threads = True
+    # The harness reads the port from the first line
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
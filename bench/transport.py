@@ -0,0 +1,33 @@
+import time
+
+import httpx
+
+# Request latencies in seconds, as seen by the client
+latencies = []
+
+
+# Sends every request to the local bench server, keeping the original host in X-Bench-Host. Speaks
+# h2c with prior knowledge and pools connections like the clients of sources.client, so the bench
+# covers HTTP/2 multiplexing, or HTTP/1.1 when asked.
+class RewriteTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, server: str, http2=True):
+        from sources.client import limits
+        super().__init__(http1=not http2, http2=http2, limits=limits)
+        self.server = httpx.URL(server)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = request.url.copy_with(scheme=self.server.scheme, host=self.server.host, port=self.server.port)
+        headers = request.headers.copy()
+        headers["X-Bench-Host"] = request.url.host
+        forward = httpx.Request(request.method, url, headers=headers, stream=request.stream,
+                                extensions=request.extensions)
+        started = time.perf_counter()
+        response = await super().handle_async_request(forward)
+        await response.aread()
+        latencies.append(time.perf_counter() - started)
+        return response
+
+
+def install(server: str, http2=True):
+    from sources.client import clients
+    clients.transport = lambda: RewriteTransport(server, http2)
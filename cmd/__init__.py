@@ -1,9 +1,11 @@
 from .build_ruby import BuildRuby
+from .compact import Compact
 from .fetch import Fetch
 from .help import Help
 from .init_db import Init
 from .make_epub import MakeEpub, MakeEpubRuby
 from .make_tex import MakeTex
+from .train_dict import TrainDict
 from .update import Update
 from .remove import Remove
 
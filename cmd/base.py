@@ -1,14 +1,25 @@
 from __future__ import annotations
 
 import abc
-from typing import Dict, Type
+from typing import Any, Callable, Dict, Type
 
 import sources
 from util import make_track_sub_meta
 
 
+def flag(value: str) -> bool:
+    return value.lower() not in ('0', 'false', 'no', 'off')
+
+
 class Base(metaclass=make_track_sub_meta("command")):
     commands: Dict[str, Type[Base]] = {}
+    options: Dict[str, Callable[[str], Any]] = {}
+    # Printed by help below the options
+    details = ""
+
+    def __init__(self, **options):
+        for name, value in options.items():
+            setattr(self, name, value)
 
     @property
     @abc.abstractmethod
@@ -25,6 +36,21 @@ class Base(metaclass=make_track_sub_meta("command")):
     def parametric(self) -> bool:
         pass
 
+    @classmethod
+    def parse_options(cls, args):
+        options = {}
+        for arg in args:
+            name, _, value = arg.removeprefix('--').partition('=')
+            name = name.replace('-', '_')
+            parser = cls.options.get(name)
+            if parser is None:
+                raise KeyError(f'Command {cls.command} does not accept option --{name}')
+            try:
+                options[name] = parser(value)
+            except ValueError as e:
+                raise ValueError(f'Bad value for option --{name}: {e}')
+        return options
+
     @abc.abstractmethod
     def execute(self, source: Type[sources.Base], source_id: str):
         pass
@@ -1,6 +1,9 @@
+import collections
 import copy
+import functools
 import sys
-from typing import List, Type
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Type
 
 from bs4 import BeautifulSoup, Tag, NavigableString, PageElement
 from janome.tokenizer import Tokenizer
@@ -9,9 +12,8 @@ from tqdm import tqdm
 
 import sources
 from util import NovelDB
-from .base import Base
+from .base import Base, flag
 
-tokenizer = Tokenizer()
 converter = K2("H")
 
 zygote = BeautifulSoup('<p></p>', 'lxml').find('p')
@@ -37,39 +39,109 @@ def make_ruby(base, reading):
     return ruby
 
 
-def rubify_string(string) -> List[PageElement]:
+# Created lazily so that only processes actually rubifying pay for loading the dictionary
+@functools.cache
+def get_tokenizer():
+    return Tokenizer()
+
+
+def render_token(base, reading) -> Tuple[str | Tuple[str, str], ...]:
+    reading, _ = converter.convert(reading)
+    if base == reading:
+        return base,
+
+    segments = []
+    prefix, suffix = '', ''
+    while base and reading and base[0] == reading[0]:
+        prefix += base[0]
+        base, reading = base[1:], reading[1:]
+    while base and reading and base[-1] == reading[-1]:
+        suffix += base[-1]
+        base, reading = base[:-1], reading[:-1]
+    if prefix:
+        segments.append(prefix)
+    if reading:
+        segments.append((base, reading))
+    else:
+        segments.append(base)
+    if suffix:
+        segments.append(suffix[::-1])
+    return tuple(segments)
+
+
+class RubyCache:
+    def __init__(self, size=65536):
+        self.size = size
+        self.entries: collections.OrderedDict[Tuple[str, str], tuple] = collections.OrderedDict()
+        self.added = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, entries):
+        for key, segments in entries.items():
+            self.store(key, segments)
+
+    def store(self, key, segments):
+        self.entries[key] = segments
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, base, reading):
+        key = (base, reading)
+        segments = self.entries.get(key)
+        if segments is None:
+            self.misses += 1
+            segments = render_token(base, reading)
+            self.added[key] = segments
+            self.store(key, segments)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return segments
+
+    # Hand over statistics and new entries gathered since the last call, worker processes
+    # report them back to the main process this way.
+    def drain(self):
+        result = self.hits, self.misses, self.added
+        self.hits, self.misses, self.added = 0, 0, {}
+        return result
+
+    def merge(self, hits, misses, added):
+        self.hits += hits
+        self.misses += misses
+        self.added.update(added)
+        self.load(added)
+
+
+# Cache of a worker process, set up from the entries of the book being rubified
+worker_cache = None
+
+
+def init_worker(entries):
+    global worker_cache
+    get_tokenizer()
+    worker_cache = RubyCache()
+    worker_cache.load(entries)
+
+
+def rubify_string(string, cache: RubyCache) -> List[PageElement]:
     content = []
-    for word in tokenizer.tokenize(str(string)):
+    for word in get_tokenizer().tokenize(str(string)):
         base, reading = word.surface, word.reading
         if base == reading or reading == '*':
             content.append(NavigableString(base))
             continue
 
-        reading, _ = converter.convert(reading)
-        if base == reading:
-            content.append(NavigableString(base))
-            continue
-
-        prefix, suffix = '', ''
-        while base and reading and base[0] == reading[0]:
-            prefix += base[0]
-            base, reading = base[1:], reading[1:]
-        while base and reading and base[-1] == reading[-1]:
-            suffix += base[-1]
-            base, reading = base[:-1], reading[:-1]
-        if prefix:
-            content.append(NavigableString(prefix))
-        if reading:
-            content.append(make_ruby(base, reading))
-        else:
-            content.append(NavigableString(base))
-        if suffix:
-            content.append(NavigableString(suffix[::-1]))
+        for segment in cache.get(base, reading):
+            if isinstance(segment, str):
+                content.append(NavigableString(segment))
+            else:
+                content.append(make_ruby(*segment))
 
     return content
 
 
-def rubify_line(p: Tag):
+def rubify_line(p: Tag, cache: RubyCache):
     if 'class' in p.attrs and 'blank' in p.attrs['class']:
         return p
 
@@ -77,41 +149,86 @@ def rubify_line(p: Tag):
     for item in p.contents:
         match item:
             case NavigableString():
-                new_content.extend(rubify_string(item))
+                new_content.extend(rubify_string(item, cache))
             case Tag():
                 new_content.append(item)
     p.clear()
     p.extend(new_content)
 
 
-def rubify_content(content):
+def rubify_content(content, cache: RubyCache):
     content = BeautifulSoup(content, 'lxml').select_one('.content')
     for line in content.contents:
         if not isinstance(line, Tag) or line.name != 'p':
             continue
 
-        rubify_line(line)
+        rubify_line(line, cache)
 
     content = content.decode()
     return content
 
 
+def rubify_job(content, cache: RubyCache = None):
+    cache = cache or worker_cache
+    return rubify_content(content, cache), cache.drain()
+
+
+def rubify_all(episodes, jobs, cache: RubyCache):
+    if jobs <= 1:
+        for episode in episodes:
+            yield episode, rubify_job(episode.content, cache)
+        return
+
+    # Results are taken in submission order, so the output is the same as the serial path.
+    # Only a few episodes per worker are in flight to keep memory bounded.
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(dict(cache.entries),)) as executor:
+        pending = collections.deque()
+        for episode in episodes:
+            pending.append((episode, executor.submit(rubify_job, episode.content)))
+            if len(pending) >= jobs * 4:
+                episode, result = pending.popleft()
+                yield episode, result.result()
+        while pending:
+            episode, result = pending.popleft()
+            yield episode, result.result()
+
+
 class BuildRuby(Base):
     command = "ruby"
     description = "update rubified version of episodes"
     parametric = True
+    options = {
+        "jobs": int,
+        "cache": flag,
+    }
+
+    jobs = 1
+    cache = True
 
     def execute(self, source: Type[sources.Base], source_id: str):
         db = NovelDB()
         book = db.find_book(source_id, source.source)
 
-        episode_ids = db.findall_episode_rubified_stale(book.id)
-        if not episode_ids:
+        count = len(db.findall_episode_rubified_stale(book.id, columns=("id",)))
+        if not count:
             print("Rubified version up to date.")
             return
 
-        for episode_id in tqdm(episode_ids, desc="Rubify episodes", file=sys.stdout):
-            s_episode = db.find_episode(book.id, episode_id.source_id)
-            content = rubify_content(s_episode.content)
-            db.add_rubified(book.id, episode_id.source_id, s_episode.title, content, s_episode.version,
-                            s_episode.creation)
+        # A cache per book, so entries of other books neither count as hits nor go missing from the
+        # entries persisted for this one. Loaded before the worker pool starts, which copies it.
+        ruby_cache = RubyCache()
+        if self.cache:
+            ruby_cache.load(db.findall_ruby_cache(book.id))
+
+        # Writes only touch episodes the stream has already passed, so the stale query is unaffected
+        with db.writer("episode_ruby") as writer:
+            rubified = rubify_all(db.iter_episode_rubified_stale(book.id), self.jobs, ruby_cache)
+            for episode, (content, stats) in tqdm(rubified, total=count, desc="Rubify episodes", file=sys.stdout):
+                ruby_cache.merge(*stats)
+                writer.add(book.id, episode.source_id, episode.title, content, episode.version, episode.creation)
+
+        hits, misses, added = ruby_cache.drain()
+        if self.cache:
+            db.add_ruby_cache(book.id, added)
+        total = hits + misses
+        print(f"Ruby cache: {hits}/{total} hits ({hits / total if total else 0:.1%}), {len(added)} new entries.")
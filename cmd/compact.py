@@ -0,0 +1,73 @@
+import sys
+
+from tqdm import tqdm
+
+from util import NovelDB
+from util.db import compression_level, zstd_compress, zstd_decompress, zstd_delta_compress, decompress_stored
+from .base import Base, flag
+
+
+class Compact(Base):
+    command = "compact"
+    description = "recompress episodes stored at the fast ingest level"
+    parametric = False
+    options = {
+        "delta": flag,
+    }
+
+    delta = False
+
+    def execute(self, _, _1):
+        db = NovelDB()
+        for table in ("episode", "episode_ruby"):
+            total = db.count_content(table, compression_level)
+            if not total:
+                print(f"All {table} rows are compacted.")
+                continue
+            self.recompress(db, table, db.iter_content(table, compression_level), total)
+        if self.delta:
+            for table in ("episode", "episode_ruby"):
+                self.delta_history(db, table)
+
+    # Rows are committed in batches and recompressed rows no longer match the query they came from,
+    # so an interrupted run simply continues next time.
+    @staticmethod
+    def recompress(db: NovelDB, table, rows, total=None):
+        count, before, after = 0, 0, 0
+        batch = []
+        for row in tqdm(rows, total=total, desc=f"Recompress {table}", file=sys.stdout):
+            content = zstd_compress(zstd_decompress(row.content, table), table)
+            count += 1
+            before += len(row.content)
+            after += len(content)
+            batch.append((content, row.id))
+            if len(batch) >= 256:
+                db.update_content(table, batch)
+                batch = []
+        db.update_content(table, batch)
+
+        print(f"Recompressed {count} {table} rows: {before} -> {after} bytes, saved {before - after} bytes.")
+
+    # Old versions are rewritten as deltas against the next newer version of the same episode,
+    # kept only when smaller. Reading one then needs every newer version up to the latest.
+    @staticmethod
+    def delta_history(db: NovelDB, table):
+        count, before, after = 0, 0, 0
+        batch = []
+        for row in tqdm(db.iter_history(table), desc=f"Delta {table}", file=sys.stdout):
+            base = db.find_content(table, row.newer)
+            content = zstd_delta_compress(zstd_decompress(row.content, table),
+                                          decompress_stored(base.content, base.delta_base, table))
+            if len(content) >= len(row.content):
+                continue
+            count += 1
+            before += len(row.content)
+            after += len(content)
+            batch.append((content, row.newer, row.id))
+            if len(batch) >= 256:
+                db.update_delta(table, batch)
+                batch = []
+        db.update_delta(table, batch)
+
+        print(f"Stored {count} old {table} versions as deltas: {before} -> {after} bytes, "
+              f"saved {before - after} bytes.")
@@ -10,7 +10,19 @@ class Fetch(Base):
     command = "fetch"
     description = "fetch new episodes"
     parametric = True
+    options = {
+        "metrics": str,
+    }
+
+    metrics = None
 
     def execute(self, source: Type[sources.Base], source_id: str):
         fetcher: sources.Base = source(source_id)
-        anyio.run(fetcher.fetch)
+        anyio.run(self.fetch, fetcher)
+
+    async def fetch(self, fetcher: sources.Base):
+        async with sources.Scheduler() as scheduler:
+            await fetcher.fetch(scheduler)
+        if self.metrics:
+            scheduler.metrics.write(self.metrics)
+            print(f"Metrics written to {self.metrics}")
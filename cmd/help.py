@@ -1,3 +1,5 @@
+import textwrap
+
 from .base import Base
 
 
@@ -12,3 +14,9 @@ class Help(Base):
             if command.parametric:
                 name += " desc"
             print(f"    {name: <14}    {command.description}")
+            for option in command.options:
+                print(f"        --{option.replace('_', '-')}")
+            for line in textwrap.wrap(command.details, 100):
+                print(f"        {line}")
+        print("Every command accepts --profile to print and save a profile of its run, "
+              "\"profile on\" turns it on for the whole console session.")
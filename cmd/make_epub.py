@@ -1,13 +1,13 @@
+import html
 import os
 import pickle
 from abc import ABC
 from typing import Type
 
-import ebooklib.epub as epub
-
 import sources
-from util import NovelDB, LinearMenu, NChapter, Episode
-from .base import Base
+from util import NovelDB, LinearMenu, NChapter, Episode, EpubWriter, TocEntry
+from util.db import decompress_stored
+from .base import Base, flag
 
 page_style = """
 /**
@@ -29,83 +29,88 @@ em.dot {
 }
 """
 
-page_css = epub.EpubItem(uid="page_style",
-                         file_name="style/page.css",
-                         media_type="text/css",
-                         content=page_style.strip().encode())
-
 
-def render_episode(episode):
-    html = f"""
-<h3>{episode.title}</h3>
-{episode.content}
-"""
+# Bump whenever the page rendering changes, so incremental builds render every page again
+render_version = 1
 
-    page = epub.EpubHtml(title=episode.title,
-                         file_name=episode.source_id + '.xhtml',
-                         content=html.encode(),
-                         lang='ja')
-    page.add_item(page_css)
 
-    return page
+def render_episode(title, content):
+    return f"""
+<h3>{html.escape(title)}</h3>
+{content}
+"""
 
 
 class MakeEpubCommon(Base, ABC):
     parametric = True
+    options = {
+        "full": flag,
+    }
     db_method = None
+    table = ""
     target_folder = ""
 
-    @classmethod
-    def execute(cls, source: Type[sources.Base], source_id: str):
+    full = False
+
+    def execute(self, source: Type[sources.Base], source_id: str):
+        cls = type(self)
         book_id = f"{source.source}:{source_id}"
 
         db = NovelDB()
         book = db.find_book(source_id, source.source)
         linear_menu: LinearMenu = pickle.loads(book.menu)
         menu = linear_menu.build_menu()
-        episodes = {i.source_id: i for i in cls.db_method(db, book.id)}
-
-        ebook = epub.EpubBook()
-        ebook.set_identifier(book_id)
-        ebook.set_language('ja')
-        ebook.spine = ['nav']
-        ebook.set_title(book.title)
-        ebook.add_author(book.author)
-        ebook.add_metadata('DC', 'description', book.description)
-        ebook.add_item(page_css)
-
-        def build_item(item):
-            if isinstance(item, Episode):
-                page = render_episode(episodes[item.id])
-                ebook.add_item(page)
-                ebook.spine.append(page)
-                return epub.Link(page.file_name, item.title, item.id)
-            elif isinstance(item, NChapter):
-                return epub.Section(item.title), [build_item(sub_item) for sub_item in item.items]
-            assert False, "Unknown item"
-
-        ebook.toc = [build_item(item) for item in menu.items]
-        ebook.add_item(epub.EpubNcx())
-        ebook.add_item(epub.EpubNav())
+        entries = {item.id for item in linear_menu.get_episodes()}
 
         epub_file = book.title[:40]
         for char in "\\/?*:\"|<>":
             epub_file = epub_file.replace(char, '_')
         target = f"{cls.target_folder}/{epub_file}.epub"
         os.makedirs(cls.target_folder, exist_ok=True)
-        epub.write_epub(target, ebook)
-        print(f"Book {book_id} saved to {target}")
+
+        # Episodes are streamed and written out one at a time, the spine follows the menu order.
+        # Each page is keyed by the row it was rendered from, unchanged pages are copied from the old file
+        # and the content of a row is only read from the database when its page is rendered again.
+        with EpubWriter(target, book_id, book.title, book.author, book.description,
+                        incremental=not self.full) as ebook:
+            ebook.add_style("page_style", "style/page.css", page_style.strip())
+
+            for episode in cls.db_method(db, book.id, ("id", "source_id", "title", "version")):
+                if episode.source_id not in entries:
+                    continue
+                file_name = episode.source_id + '.xhtml'
+                key = f"{render_version}:{episode.id}:{episode.version}"
+                if not ebook.reuse_page(file_name, key):
+                    stored = db.find_content(cls.table, episode.id)
+                    content = decompress_stored(stored.content, stored.delta_base, cls.table)
+                    ebook.add_page(file_name, episode.title, render_episode(episode.title, content), key)
+
+            def build_item(item):
+                if isinstance(item, Episode):
+                    file_name = item.id + '.xhtml'
+                    if file_name not in ebook.pages:
+                        raise RuntimeError(f"Episode {item.id} of book {book_id} is not stored")
+                    return TocEntry(item.title, file_name)
+                elif isinstance(item, NChapter):
+                    return TocEntry(item.title, children=[build_item(sub_item) for sub_item in item.items])
+                assert False, "Unknown item"
+
+            ebook.finish([build_item(item) for item in menu.items])
+            reused = ebook.reused
+        print(f"Book {book_id} saved to {target} ({reused} unchanged pages reused)")
 
 
 class MakeEpub(MakeEpubCommon):
     command = "epub"
     description = "build book EPUB"
-    db_method = NovelDB.findall_episode
+    db_method = NovelDB.iter_episode
+    table = "episode"
     target_folder = "epubfile"
 
 
 class MakeEpubRuby(MakeEpubCommon):
     command = "epub_ruby"
     description = "build book EPUB use Rubified episode"
-    db_method = NovelDB.findall_rubified
+    db_method = NovelDB.iter_rubified
+    table = "episode_ruby"
     target_folder = "epub_ruby_file"
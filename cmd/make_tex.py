@@ -9,7 +9,7 @@ from bs4 import BeautifulSoup, Tag, NavigableString
 from tqdm import tqdm
 
 import sources
-from util import NovelDB, LinearMenu, Episode
+from util import NovelDB, LinearMenu
 from .base import Base
 
 
@@ -80,16 +80,18 @@ class MakeTex(Base):
         db = NovelDB()
         book = db.find_book(source_id, source.source)
         linear_menu: LinearMenu = pickle.loads(book.menu)
-        episodes = {i.source_id: i for i in db.findall_episode(book.id)}
 
         folder = book.title[:63]
         for char in "\\/?*:\"|<>":
             folder = folder.replace(char, '_')
         folder = pathlib.Path("texfile") / folder
         os.makedirs(folder, exist_ok=True)
-        entries = [item for item in linear_menu.items if isinstance(item, Episode)]
-        for idx, item in enumerate(tqdm(entries, desc="Render episodes", file=sys.stdout)):
-            tex = render_episode(episodes[item.id]).encode()
+        entries = {item.id: idx for idx, item in enumerate(linear_menu.get_episodes())}
+        for episode in tqdm(db.iter_episode(book.id), total=len(entries), desc="Render episodes", file=sys.stdout):
+            idx = entries.get(episode.source_id)
+            if idx is None:
+                continue
+            tex = render_episode(episode).encode()
             file = folder / f"{idx + 1:0>4}.tex"
             try:
                 with open(file, "rb") as episode:
@@ -0,0 +1,50 @@
+import zstandard
+
+import sources
+from util import NovelDB
+from util.db import compression_level, current_dict, frame_dict_id, reset_compressor, zstd_decompress
+from .base import Base, flag
+from .compact import Compact
+
+
+class TrainDict(Base):
+    command = "train"
+    description = "train zstd dictionaries from stored episodes, then recompress them before returning"
+    parametric = False
+    options = {
+        "samples": int,
+        "size": int,
+        "recompress": flag,
+    }
+
+    samples = 2000
+    size = 65536
+    recompress = True
+
+    def execute(self, _, _1):
+        db = NovelDB()
+        for category in ("episode", "episode_ruby"):
+            samples = []
+            for source in sources.Base.sources:
+                samples.extend(zstd_decompress(content, category).encode(encoding="utf-8")
+                               for content in db.sample_content(category, source, self.samples))
+
+            try:
+                trained = zstandard.train_dictionary(self.size, samples, level=compression_level)
+            except zstandard.ZstdError as e:
+                print(f"Can't train {category} dictionary from {len(samples)} samples: {e}")
+                continue
+
+            # The dict id comes from the dictionary content, unchanged samples train the same dictionary again
+            dict_id = trained.dict_id()
+            if current_dict(category).dict_id() == dict_id:
+                print(f"The {category} dictionary {dict_id} is unchanged.")
+            else:
+                db.add_dict(category, dict_id, trained.as_bytes())
+                reset_compressor(category)
+                print(f"Trained {category} dictionary {dict_id} from {len(samples)} samples.")
+
+            # Runs in the foreground, --recompress=off leaves the rows on their old dictionaries
+            if self.recompress:
+                Compact.recompress(db, category, (row for row in db.iter_content(category)
+                                                  if frame_dict_id(row.content) != dict_id))
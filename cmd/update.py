@@ -1,22 +1,78 @@
-from typing import Type
+from typing import Dict
 
 import anyio
 
 import sources
 from util import NovelDB
-from .base import Base
+from .base import Base, flag
+
+
+def parse_per_source(convert):
+    def parse(value: str) -> Dict[str, int | float]:
+        limits = {}
+        for item in value.split(','):
+            source, _, limit = item.partition(':')
+            if source not in sources.Base.sources:
+                raise ValueError(f"unknown source {source}")
+            limits[source] = convert(limit)
+        return limits
+
+    return parse
 
 
 class Update(Base):
     command = "update"
     description = "update all books by fetching new episodes"
+    details = ("Syosetu TOCs that only got new episodes are loaded from the last stored page. An older episode "
+               "revised shortly before new ones were posted is then missed until the whole TOC is loaded again, "
+               "which happens once a book went --full-toc-days (7 by default) on reused pages. --full-toc loads "
+               "every TOC in full.")
     parametric = False
+    options = {
+        "concurrency": int,
+        "limit": parse_per_source(int),
+        "rate": parse_per_source(float),
+        "probe": flag,
+        "full_toc": flag,
+        "full_toc_days": float,
+        "metrics": str,
+    }
+
+    concurrency = 16
+    limit = {}
+    rate = {}
+    probe = True
+    full_toc = False
+    full_toc_days = 7.0
+    metrics = None
 
     def execute(self, _, _1):
         db = NovelDB()
         books = db.findall_book()
 
-        for book in books:
-            fetcher: sources.Base = sources.Base.sources[book.source](book.source_id)
-            anyio.run(fetcher.fetch)
-            print()
+        anyio.run(self.fetch_all, books)
+
+    async def fetch_all(self, books):
+        failed = []
+
+        async def fetch(fetcher: sources.Base):
+            try:
+                await fetcher.fetch(scheduler, skip_unchanged=self.probe)
+            except Exception as e:
+                fetcher.log(f"Book {fetcher.composite_source} failed: {e.__class__.__name__} {e}")
+                failed.append(fetcher.composite_source)
+
+        async with sources.Scheduler(self.concurrency, self.limit, self.rate, shared=True) as scheduler:
+            async with anyio.create_task_group() as tg:
+                for book in books:
+                    fetcher = sources.Base.sources[book.source](book.source_id)
+                    fetcher.incremental = not self.full_toc
+                    fetcher.full_menu_days = self.full_toc_days
+                    tg.start_soon(fetch, fetcher)
+
+        print(f"Updated {len(books) - len(failed)} books.")
+        if failed:
+            print(f"Failed books: {', '.join(failed)}")
+        if self.metrics:
+            scheduler.metrics.write(self.metrics)
+            print(f"Metrics written to {self.metrics}")
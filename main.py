@@ -1,8 +1,14 @@
 import code
+import contextlib
 import sys
 
 import cmd
 import sources
+from cmd.base import flag
+from util.profiling import profiled
+
+# Profile every command, toggled by "profile" in the console
+profiling = False
 
 
 def handle_once(fields, last):
@@ -12,6 +18,25 @@ def handle_once(fields, last):
         print(f'Unknown command "{raw_action}"')
         return []
 
+    profile = profiling
+    for arg in args:
+        name, _, value = arg.removeprefix('--').partition('=')
+        if arg.startswith('--') and name == 'profile':
+            profile = flag(value)
+    args = [arg for arg in args if arg.partition('=')[0] != '--profile']
+
+    with profiled(raw_action) if profile else contextlib.nullcontext():
+        return run_action(raw_action, action, args, last)
+
+
+def run_action(raw_action, action, args, last):
+    try:
+        options = action.parse_options(arg for arg in args if arg.startswith('--'))
+    except (KeyError, ValueError) as e:
+        print(e.args[0])
+        return None
+
+    args = [arg for arg in args if not arg.startswith('--')]
     if args:
         if not action.parametric:
             print(f'Command {raw_action} does not accept parameters')
@@ -26,10 +51,10 @@ def handle_once(fields, last):
             print(f'Command {raw_action} accepts parameters but no parameter is given')
             return None
         for source, source_id in last:
-            action().execute(source, source_id)
+            action(**options).execute(source, source_id)
     else:
         last = None
-        action().execute(None, None)
+        action(**options).execute(None, None)
 
     return last
 
@@ -59,6 +84,12 @@ class MyInteractive(code.InteractiveConsole):
             self.closed = True
             return False
 
+        if fields[0] == "profile":
+            global profiling
+            profiling = flag(fields[1]) if len(fields) > 1 else not profiling
+            print(f"Profiling {'on' if profiling else 'off'}.")
+            return False
+
         self.last = handle_once(fields, self.last)
         return False
 
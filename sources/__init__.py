@@ -3,3 +3,4 @@ from .kakuyomu import Kakuyomu
 from .syosetu import Syosetu
 
 from .base import Base
+from .scheduler import Scheduler
@@ -1,22 +1,21 @@
-import copy
 import re
 import zoneinfo
 from datetime import datetime
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 
 from util import Chapter, Episode
+from . import markup
 from .base import Base
-from .tools import *
+from .tools import normalize_ruby_emphasis
 
 
 class Alphapolis(Base):
     source = "alphapolis"
     zone = zoneinfo.ZoneInfo('Asia/Tokyo')
-    p = BeautifulSoup('<p></p>', 'lxml').find('p')
 
     def __init__(self, book_id, limit=2, tries=3):
-        super().__init__(book_id, limit, tries, source="alphapolis", source_unique_episode_id=True)
+        super().__init__(book_id, limit, tries, source_unique_episode_id=True)
 
     confident_re = re.compile(r"(https?://)?www\.alphapolis\.co\.jp/novel/(?P<id>[0-9]{8,9}/[0-9]{8,9})/?")
     maybe_confident_re = re.compile(r"[0-9]{8,9}/[0-9]{8,9}")
@@ -36,8 +35,8 @@ class Alphapolis(Base):
         return 0, ""
 
     async def fetch_metadata(self):
-        print(f"Loading metadata of book {self.book_id}...")
-        page = await self.get_retry(f"https://www.alphapolis.co.jp/novel/{self.book_id}")
+        async with self.limiter:
+            page = await self.get_retry(f"https://www.alphapolis.co.jp/novel/{self.book_id}", cache=True)
         content = BeautifulSoup(page.content, 'lxml')
 
         self.title = content.select_one('h1.title').text.strip()
@@ -65,47 +64,47 @@ class Alphapolis(Base):
     async def fetch_episode(self, episode: Episode):
         async with self.limiter:
             page = await self.get_retry(f"https://www.alphapolis.co.jp/novel/{self.book_id}/episode/{episode.id}")
+        return page.content
 
-        content = BeautifulSoup(page.content, "lxml")
-        content = content.select_one("#novelBody")
-        content.attrs = {'class': 'content'}
-
-        # Rewrite to p-based formatting
-        contents = []
-        line = copy.copy(self.p)
+    @classmethod
+    def parse_episode(cls, raw):
+        document = markup.parse(raw, html=True)
+        content = next(document.iterfind(".//*[@id='novelBody']"), None)
+        if content is None:
+            raise RuntimeError("Can't find content")
+        markup.collapse_whitespace(content, html=True)
+
+        open_tags = set()
+        normalize_ruby_emphasis(content, True, open_tags)
+
+        # Rewrite to p-based formatting in one pass over the children, writing each line once it
+        # is known whether it only holds <br>.
+        output = ['<div class="content">']
+        line = []
         all_br = True
-        for el in list(content):
-            el = el.extract()
-            if isinstance(el, NavigableString) and not el.strip():
+        for el in markup.children(content):
+            if isinstance(el, str) and not el.strip():
                 continue
-            if isinstance(el, Tag) and el.name == 'br':
+            if not isinstance(el, str) and el.tag == 'br':
                 if all_br:
-                    line.append(el)
+                    line.append(markup.serialize(el, True) if len(el.attrib) else '<br/>')
                 else:
-                    contents.append(line)
-                    line = copy.copy(self.p)
+                    output += ['<p>', *line, '</p>\n']
+                    line = []
                     all_br = True
             else:
-                if all_br and line.contents:
-                    line.attrs['class'] = 'blank'
-                    contents.append(line)
-                    line = copy.copy(self.p)
-                if isinstance(el, NavigableString):
-                    el = NavigableString(el.removeprefix('\n'))
+                if all_br and line:
+                    output += ['<p class="blank">', *line, '</p>\n']
+                    line = []
+                if isinstance(el, str):
+                    line.append(markup.escape(el.removeprefix('\n')))
+                else:
+                    line.append(markup.serialize(el, True, open_tags))
                 all_br = False
-                line.append(el)
-        if all_br:
-            line.attrs['class'] = 'blank'
-        if line.contents:
-            contents.append(line)
-
-        newlines = [NavigableString('\n') for _ in range(len(contents))]
-        contents = [i for pair in zip(contents, newlines) for i in pair]
-        content.clear(True)
-        content.extend(contents)
-
-        normalize_ruby_emphasis(content)
+        if line:
+            output += ['<p class="blank">' if all_br else '<p>', *line, '</p>\n']
+        output.append('</div>')
 
-        content = content.decode()
+        content = ''.join(output)
         return content
 
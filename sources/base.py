@@ -3,15 +3,23 @@ from __future__ import annotations
 import abc
 import base64
 import json
+import math
 import pickle
 import sys
-from typing import Tuple, Dict, Type
+import time
+from typing import Tuple, Dict, List, Type
 
 import anyio
 import httpx
 from tqdm import tqdm
 
-from util import NovelDB, Episode, LinearMenu, make_track_sub_meta
+from util import NovelDB, Episode, LinearMenu, make_track_sub_meta, zstd_compress
+from util.db import content_digest, dict_payload, ingest_compression_level
+from . import metrics
+from .cache import response_cache
+from .client import clients
+from .scheduler import Scheduler
+from .throttle import backoff_delay, retry_after
 
 
 def create_or_append(dict_, key, value):
@@ -24,33 +32,22 @@ def create_or_append(dict_, key, value):
 class Base(metaclass=make_track_sub_meta("source")):
     sources: Dict[str, Type[Base]] = {}
 
+    headers: Dict[str, str] = {}
+    cookies: Dict[str, str] = {}
+    timeout = httpx.Timeout(5)
+    # Requests per second allowed by the token bucket of the source
+    rate = math.inf
+    # Set by update, sources may then reuse metadata stored by the last fetch instead of loading it all
+    incremental = False
+    # Days a book may keep reusing stored metadata before it is loaded in full again, set by update
+    full_menu_days = 7.0
+
     def __init__(self, book_id, limit=2, tries=3, source_unique_episode_id=True):
-        self.client = httpx.AsyncClient(
-            http2=True,
-            headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
-                              'Chrome/126.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,'
-                          '*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-                'Accept-Language': 'ja;ja-JP,q=0.9',
-                'Priority': 'u=0, i',
-                'Sec-Ch-Ua': '"Not/A)Brand";v="8", "Chromium";v="126", "Google Chrome";v="126"',
-                'Sec-Ch-Ua-Mobile': '?0',
-                'Sec-Ch-Ua-Platform': '"Windows"',
-                'Sec-Fetch-Dest': 'document',
-                'Sec-Fetch-Mode': 'navigate',
-                'Sec-Fetch-Site': 'same-origin',
-                'Sec-Fetch-User': '?1',
-                'Upgrade-Insecure-Requests': '1',
-            }
-        )
         self.db = NovelDB()
 
         self.limit = limit
         self.tries = tries
 
-        self.retry_count = 0
-
         self.book_id = book_id
         self.book_db_id = None
         self.source_unique_episode_id = source_unique_episode_id
@@ -60,30 +57,72 @@ class Base(metaclass=make_track_sub_meta("source")):
         self.description = None
         self.menu = LinearMenu()
 
-    async def send_retry(self, request: httpx.Request):
+        self.scheduler: Scheduler | None = None
+        self.limiter = None
+        self.writer = None
+        self.dictionary = None
+
+    @staticmethod
+    def log(message: str):
+        tqdm.write(message, file=sys.stdout)
+
+    def client(self, url) -> httpx.AsyncClient:
+        return clients.get(httpx.URL(url).host, self.headers, self.cookies, self.timeout)
+
+    # Pages polled on every update are sent with cache=True, see ResponseCache.
+    # Every attempt, retries included, waits for the source throttle and takes a token of its rate.
+    # Outcomes are reported to the throttle, failed attempts back off exponentially with jitter
+    # or for as long as the server asked with Retry-After.
+    async def send_retry(self, request: httpx.Request, cache=False):
+        if cache:
+            response_cache.prepare(request)
+        throttle = self.limiter.throttle
         result = None
-        for i in range(self.tries):
+        i = 0
+        while i < self.tries:
+            delay = None
+            with metrics.timed("queue"):
+                await throttle.wait()
+            started = time.monotonic()
             try:
-                result = await self.client.send(request)
+                with metrics.timed("network"):
+                    result = await self.client(request.url).send(request)
             except httpx.TimeoutException as e:
-                print(f"Failed {request.method} {request.url} (Attempt #{i + 1}): Exception {e.__class__.__name__}")
+                self.log(f"Failed {request.method} {request.url} (Attempt #{i + 1}): Exception {e.__class__.__name__}")
+                throttle.failure()
             else:
+                if cache and result.status_code == httpx.codes.NOT_MODIFIED and response_cache.conditional(request):
+                    throttle.success(time.monotonic() - started)
+                    cached = response_cache.load(request)
+                    if cached is not None:
+                        return cached
+                    # Evicted since the request was made conditional, ask again for the whole page
+                    # right away, without using up an attempt
+                    response_cache.unprepare(request)
+                    continue
                 if result.is_success or result.has_redirect_location:
+                    throttle.success(time.monotonic() - started)
+                    if cache and result.is_success:
+                        response_cache.store(result)
                     return result
-                print(f"Failed {request.method} {request.url} (Attempt #{i + 1}): {result.reason_phrase}")
+                self.log(f"Failed {request.method} {request.url} (Attempt #{i + 1}): {result.reason_phrase}")
+                if result.status_code == httpx.codes.TOO_MANY_REQUESTS or result.is_server_error:
+                    delay = retry_after(result)
+                    throttle.failure(delay)
             if i + 1 != self.tries:
-                self.retry_count += 1
-                if self.progress is not None:
-                    self.progress.set_postfix({"retry": self.retry_count})
-                await anyio.sleep(1)
+                self.scheduler.retry()
+                await anyio.sleep(max(delay or 0, backoff_delay(i)))
+            i += 1
+        if result is None:
+            raise httpx.TimeoutException(f"Timeout {request.method} {request.url}", request=request)
         result.raise_for_status()
         assert False, "Should raise"
 
-    async def get_retry(self, url, *args, **kwargs):
-        return await self.send_retry(self.client.build_request("GET", url, *args, **kwargs))
+    async def get_retry(self, url, *args, cache=False, **kwargs):
+        return await self.send_retry(self.client(url).build_request("GET", url, *args, **kwargs), cache)
 
     async def post_retry(self, url, *args, **kwargs):
-        return await self.send_retry(self.client.build_request("POST", url, *args, **kwargs))
+        return await self.send_retry(self.client(url).build_request("POST", url, *args, **kwargs))
 
     @staticmethod
     def common_normalize(content: str):
@@ -126,30 +165,99 @@ class Base(metaclass=make_track_sub_meta("source")):
 
         return Source, source_id
 
+    # Cheap summary of the book state, like a last updated time, fetched in one request. When it
+    # matches the one stored by the last complete fetch, the book is skipped without loading metadata.
+    # Sources without such a probe return None and are always loaded in full.
+    async def probe(self) -> str | None:
+        return None
+
     @abc.abstractmethod
     async def fetch_metadata(self):
         pass
 
-    @abc.abstractmethod
-    async def fetch_episode(self, episode: Episode):
+    # Whether a book the probe reports unchanged must be loaded anyway, as for sources that may have
+    # missed changes by reusing stored metadata
+    def needs_refresh(self, book) -> bool:
+        return False
+
+    # Called once the book is completely stored
+    def fetched(self):
         pass
 
-    async def save_episode(self, episode: Episode):
-        content = await self.fetch_episode(episode)
-        content = self.common_normalize(content)
+    # Called with the episodes about to be fetched, for sources loading them in batches
+    def plan_episodes(self, episodes: List[Episode]):
+        pass
 
-        self.db.add_episode(self.book_db_id, episode.id, episode.title, content, episode.version, episode.creation)
-        self.progress.update()
+    @abc.abstractmethod
+    async def fetch_episode(self, episode: Episode) -> bytes | str:
+        pass
 
-    async def fetch(self):
-        print(f"Loading metadata of book {self.composite_source}...")
-        await self.fetch_metadata()
+    @classmethod
+    @abc.abstractmethod
+    def parse_episode(cls, raw: bytes | str) -> str:
+        pass
+
+    # Runs in a worker process, keep the CPU heavy part of saving an episode off the event loop.
+    # Compresses with the dict_payload resolved by the parent, workers don't touch the database.
+    # Also returns the time taken by each step, see Metrics.
+    @classmethod
+    def prepare_episode(cls, raw: bytes | str, dictionary: Tuple[int, bytes]) -> Tuple[bytes, bytes, Dict[str, float]]:
+        started = time.perf_counter()
+        content = cls.parse_episode(raw)
+        parsed = time.perf_counter()
+        content = cls.common_normalize(content)
+        normalized = time.perf_counter()
+        compressed = zstd_compress(content, "episode", ingest_compression_level, dictionary)
+        digest = content_digest(content)
+        timings = {
+            "parse": parsed - started,
+            "normalize": normalized - parsed,
+            "compress": time.perf_counter() - normalized,
+        }
+        return compressed, digest, timings
 
-        print(f"Book {self.composite_source} metadata loaded.")
-        print(f"《{self.title}》 by {self.author}.")
+    async def save_episode(self, episode: Episode):
+        with self.scheduler.metrics.record("episode", self.source, self.book_id, episode.id) as record:
+            raw = await self.fetch_episode(episode)
+            content, digest, timings = await self.scheduler.offload(self.prepare_episode, raw, self.dictionary)
+            record.update(timings)
+            record["bytes_in"] = len(raw.encode() if isinstance(raw, str) else raw)
+            record["bytes_out"] = len(content)
+
+            self.writer.add(self.book_db_id, episode.id, episode.title, content, episode.version, episode.creation,
+                            digest)
+        self.scheduler.advance()
+
+    async def fetch(self, scheduler: Scheduler = None, skip_unchanged=False):
+        if scheduler is None:
+            async with Scheduler() as scheduler:
+                return await self.fetch(scheduler, skip_unchanged)
+
+        self.scheduler = scheduler
+        self.limiter = scheduler.limiter(self)
+
+        # Only probed when it can save the fetch, a plain fetch loads everything anyway
+        freshness = None
+        if skip_unchanged:
+            try:
+                freshness = await self.probe()
+            except Exception as e:
+                self.log(f"Book {self.composite_source} probe failed: {e.__class__.__name__} {e}")
+        if freshness is not None:
+            book = self.db.find_book(self.book_id, self.source)
+            if book is not None and book.freshness == freshness and not self.needs_refresh(book):
+                self.log(f"Book {self.composite_source} unchanged.")
+                return
+
+        self.log(f"Loading metadata of book {self.composite_source}...")
+        with self.scheduler.metrics.record("metadata", self.source, self.book_id):
+            await self.fetch_metadata()
+
+        self.log(f"Book {self.composite_source} metadata loaded.")
+        self.log(f"《{self.title}》 by {self.author}.")
 
         episodes = self.menu.get_episodes()
-        print(f"There are {len(episodes)} episodes.")
+        self.log(f"There are {len(episodes)} episodes.")
 
         book = self.db.find_book(self.book_id, self.source)
 
@@ -191,14 +299,27 @@ class Base(metaclass=make_track_sub_meta("source")):
         episodes = [episode for episode in episodes
                     if episode.version != fetched.get(episode.id, -1)]
 
-        print(f"There are {len(episodes)} new or updated episodes.")
+        self.log(f"There are {len(episodes)} new or updated episodes.")
 
         if episodes:
-            with tqdm(desc="Fetching episodes", total=len(episodes), file=sys.stdout) as self.progress:
+            self.dictionary = dict_payload("episode")
+            self.plan_episodes(episodes)
+            self.scheduler.add(len(episodes))
+            pending = iter(episodes)
+
+            async def worker():
+                for item in pending:
+                    await self.save_episode(item)
+
+            def observer(rows, seconds):
+                self.scheduler.metrics.commit(self.source, self.book_id, rows, seconds)
+
+            with self.db.writer("episode", observer=observer) as self.writer:
                 async with anyio.create_task_group() as tg:
-                    self.limiter = anyio.CapacityLimiter(self.limit)
-                    for episode in episodes:
-                        tg.start_soon(self.save_episode, episode)
-            self.progress = None
+                    for _ in range(self.scheduler.workers(self, len(episodes))):
+                        tg.start_soon(worker)
 
-        print(f"Book {self.composite_source} done.")
+        self.fetched()
+        if freshness is not None:
+            self.db.update_book_freshness(self.book_db_id, freshness)
+        self.log(f"Book {self.composite_source} done.")
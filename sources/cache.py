@@ -0,0 +1,96 @@
+import json
+import sqlite3
+import time
+
+import httpx
+import zstandard
+
+# Response headers kept with a cached body, the body is stored decoded so no Content-Encoding
+kept_headers = ('content-type', 'etag', 'last-modified')
+
+
+# On-disk cache of GET responses that carry validators. Requests for cached urls are made conditional,
+# a 304 is answered from the cache. Least recently used entries are evicted past max_size bytes.
+class ResponseCache:
+    def __init__(self, path="http_cache.db", max_size=64 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._db = None
+        self.cctx = zstandard.ZstdCompressor(level=3)
+        self.dctx = zstandard.ZstdDecompressor()
+
+    @property
+    def db(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS response(
+                url TEXT PRIMARY KEY,
+                headers TEXT, -- json
+                body BLOB,
+                size INTEGER,
+                accessed REAL
+            )""")
+            db.execute("CREATE INDEX IF NOT EXISTS response_accessed ON response(accessed)")
+            self._db = db
+        return self._db
+
+    def prepare(self, request: httpx.Request):
+        row = self.db.execute("SELECT headers FROM response WHERE url == ?", (str(request.url),)).fetchone()
+        if row is None:
+            return
+        headers = json.loads(row[0])
+        if 'etag' in headers:
+            request.headers['If-None-Match'] = headers['etag']
+        if 'last-modified' in headers:
+            request.headers['If-Modified-Since'] = headers['last-modified']
+
+    @staticmethod
+    def conditional(request: httpx.Request) -> bool:
+        return 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers
+
+    # Drops the validators added by prepare, when the entry they refer to is gone
+    @staticmethod
+    def unprepare(request: httpx.Request):
+        request.headers.pop('If-None-Match', None)
+        request.headers.pop('If-Modified-Since', None)
+
+    def load(self, request: httpx.Request) -> httpx.Response | None:
+        url = str(request.url)
+        row = self.db.execute("SELECT headers, body FROM response WHERE url == ?", (url,)).fetchone()
+        if row is None:
+            return None
+        with self.db:
+            self.db.execute("UPDATE response SET accessed = ? WHERE url == ?", (time.time(), url))
+        return httpx.Response(200, headers=json.loads(row[0]), content=self.dctx.decompress(row[1]),
+                              request=request)
+
+    def store(self, response: httpx.Response):
+        headers = {name: response.headers[name] for name in kept_headers if name in response.headers}
+        if 'etag' not in headers and 'last-modified' not in headers:
+            return
+        body = self.cctx.compress(response.content)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO response(url, headers, body, size, accessed) "
+                            "VALUES(?, ?, ?, ?, ?)",
+                            (str(response.request.url), json.dumps(headers), body, len(body), time.time()))
+            self.evict()
+
+    def evict(self):
+        total, = self.db.execute("SELECT coalesce(sum(size), 0) FROM response").fetchone()
+        if total <= self.max_size:
+            return
+        for url, size in self.db.execute("SELECT url, size FROM response ORDER BY accessed").fetchall():
+            self.db.execute("DELETE FROM response WHERE url == ?", (url,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+response_cache = ResponseCache()
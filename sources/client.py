@@ -0,0 +1,55 @@
+from typing import Callable, Dict
+
+import httpx
+
+headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/126.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,'
+              '*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'Accept-Language': 'ja;ja-JP,q=0.9',
+    'Priority': 'u=0, i',
+    'Sec-Ch-Ua': '"Not/A)Brand";v="8", "Chromium";v="126", "Google Chrome";v="126"',
+    'Sec-Ch-Ua-Mobile': '?0',
+    'Sec-Ch-Ua-Platform': '"Windows"',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'same-origin',
+    'Sec-Fetch-User': '?1',
+    'Upgrade-Insecure-Requests': '1',
+}
+
+# HTTP/2 multiplexes requests over one connection per host, the extra connections only
+# matter when a host falls back to HTTP/1.1.
+limits = httpx.Limits(max_connections=8, max_keepalive_connections=4, keepalive_expiry=60)
+
+
+class ClientRegistry:
+    def __init__(self):
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        # Set by the benchmarks to send every request to their local server
+        self.transport: Callable[[], httpx.AsyncBaseTransport] | None = None
+
+    def get(self, host: str, extra_headers=None, cookies=None, timeout=None) -> httpx.AsyncClient:
+        client = self.clients.get(host)
+        if client is None:
+            client = httpx.AsyncClient(
+                http2=True,
+                headers=headers | (extra_headers or {}),
+                cookies=cookies,
+                timeout=timeout or httpx.Timeout(5),
+                limits=limits,
+                transport=None if self.transport is None else self.transport(),
+            )
+            self.clients[host] = client
+        return client
+
+    async def aclose(self):
+        clients, self.clients = self.clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+
+# Clients are bound to the event loop they are first used in, so whoever runs the loop
+# (see Scheduler) closes them before it exits.
+clients = ClientRegistry()
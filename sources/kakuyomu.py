@@ -5,11 +5,11 @@ from datetime import datetime
 
 import httpx
 import anyio
-from bs4 import BeautifulSoup
 
 from util import Chapter, Episode
+from . import markup
 from .base import Base
-from .tools import *
+from .tools import normalize_ruby_emphasis
 
 query_metadata = """query GetWorkPage($workId: ID!) {
   work(id: $workId) {
@@ -42,31 +42,25 @@ query_metadata = """query GetWorkPage($workId: ID!) {
 }"""
 
 
-query_episodes = """query GetWorkPage($workId: ID!) {
-  work(id: $workId) {
-    tableOfContents {
-      episodeUnions {
-        ... on Episode {
-          id
-          bodyHTML
-        }
-      }
-    }
-  }
-}"""
+# Bodies are requested for a batch of episodes at a time, one aliased field per episode
+def make_query_episodes(count):
+    variables = ", ".join(f"$e{i}: ID!" for i in range(count))
+    fields = "\n".join(f"  e{i}: episode(id: $e{i}) {{\n    id\n    bodyHTML\n  }}" for i in range(count))
+    return f"query GetEpisodes({variables}) {{\n{fields}\n}}"
 
 
 class Kakuyomu(Base):
     source = "kakuyomu"
+    headers = {"X-Requested-With": "XMLHttpRequest"}
+    timeout = httpx.Timeout(30)
+    batch_size = 20
 
     def __init__(self, book_id, limit=math.inf, tries=3):
         super().__init__(book_id, limit, tries, source_unique_episode_id=True)
 
-        self.client.headers.update({"X-Requested-With": "XMLHttpRequest"})
-        self.client.timeout = httpx.Timeout(60)
         self.episodes = {}
-        self.episodes_loaded = None
-        self.progress = None
+        self.batches = {}
+        self.loading = {}
 
     confident_re = re.compile(r"(https?://)?kakuyomu\.jp/works/(?P<id>[0-9]{18,20})/?")
     maybe_confident_re = re.compile(r"(168[0-9]{17})|(117[0-9]{16})|(82[0-9]{16})")
@@ -85,33 +79,52 @@ class Kakuyomu(Base):
             return 1, match[0]
         return 0, ""
 
-    async def load_episodes(self):
-        if self.episodes_loaded is None:
-            self.episodes_loaded = anyio.Event()
-        else:
-            await self.episodes_loaded.wait()
+    def plan_episodes(self, episodes):
+        for i in range(0, len(episodes), self.batch_size):
+            batch = [episode.id for episode in episodes[i:i + self.batch_size]]
+            for episode_id in batch:
+                self.batches[episode_id] = batch
+
+    # Only the first caller loads a batch, the others wait for it. When the load fails it raises for
+    # the first caller alone, the others find their bodies missing, see fetch_episode.
+    # Episodes the response has no body for, as when one was deleted, are stored as None.
+    async def load_batch(self, batch):
+        key = tuple(batch)
+        loading = self.loading.get(key)
+        if loading is not None:
+            await loading.wait()
             return
-
-        page = await self.post_retry("https://kakuyomu.jp/graphql?opname=GetWorkPage", json={
-            "operationName": "GetWorkPage",
-            "variables": {"workId": self.book_id},
-            "query": query_episodes
-        })
-
-        data = json.loads(page.content)
-        work = data['data']['work']
-        for table in work['tableOfContents']:
-            for episode in table['episodeUnions']:
-                self.episodes[episode['id']] = episode['bodyHTML']
-
-        self.episodes_loaded.set()
+        loading = self.loading[key] = anyio.Event()
+
+        try:
+            async with self.limiter:
+                page = await self.post_retry("https://kakuyomu.jp/graphql?opname=GetEpisodes", json={
+                    "operationName": "GetEpisodes",
+                    "variables": {f"e{i}": episode_id for i, episode_id in enumerate(batch)},
+                    "query": make_query_episodes(len(batch))
+                })
+
+            data = json.loads(page.content)
+            if data.get('data') is None:
+                errors = "; ".join(error.get('message', '') for error in data.get('errors') or [])
+                more = f" and {len(batch) - 1} more" if len(batch) > 1 else ""
+                raise RuntimeError(f"Can't load episode {batch[0]}{more}: {errors or 'no data'}")
+            for i, episode_id in enumerate(batch):
+                episode = data['data'].get(f"e{i}")
+                self.episodes[episode_id] = None if episode is None else episode['bodyHTML']
+        except BaseException:
+            del self.loading[key]
+            raise
+        finally:
+            loading.set()
 
     async def fetch_metadata(self):
-        page = await self.post_retry("https://kakuyomu.jp/graphql?opname=GetWorkPage", json={
-            "operationName": "GetWorkPage",
-            "variables": {"workId": self.book_id},
-            "query": query_metadata
-        })
+        async with self.limiter:
+            page = await self.post_retry("https://kakuyomu.jp/graphql?opname=GetWorkPage", json={
+                "operationName": "GetWorkPage",
+                "variables": {"workId": self.book_id},
+                "query": query_metadata
+            })
         data = json.loads(page.content)
 
         work = data['data']['work']
@@ -128,28 +141,43 @@ class Kakuyomu(Base):
                 creation = int(datetime.fromisoformat(episode['publishedAt']).timestamp())
                 self.menu.push_item(Episode(episode['id'], episode['title'], version, creation))
 
+    # Bodies are dropped once handed out, only batches being saved are kept in memory.
+    # When the batch failed to load, the episode is loaded on its own.
     async def fetch_episode(self, episode: Episode):
-        if not self.episodes:
-            await self.load_episodes()
+        if episode.id not in self.episodes:
+            await self.load_batch(self.batches.get(episode.id, [episode.id]))
+        if episode.id not in self.episodes:
+            await self.load_batch([episode.id])
+        body = self.episodes.pop(episode.id)
+        if body is None:
+            raise RuntimeError(f"Episode {episode.id} has no body, it may have been deleted")
+        return body
 
-        content = BeautifulSoup(self.episodes[episode.id], 'lxml')
-        content = content.select_one("body")
-        content.name = 'div'
-        content.attrs = {'class': 'content'}
+    @classmethod
+    def parse_episode(cls, raw):
+        document = markup.parse(raw, html=True)
+        content = next(document.iter("body"), None)
+        if content is None:
+            raise RuntimeError("Can't find content")
+        markup.collapse_whitespace(content, html=True)
+        content.tag = 'div'
+        content.attrib.clear()
+        content.set('class', 'content')
 
         # clean id on <p>
-        for p in content.select('p'):
-            del p.attrs['id']
+        for p in content.iter('p'):
+            del p.attrib['id']
 
         # normalize emphasis
-        for em in content.select('em.emphasisDots'):
-            em.attrs = {'class': 'dot'}
-            text = NavigableString(em.text.strip())
-            em.clear(True)
-            em.append(text)
+        for em in [em for em in content.iter('em') if 'emphasisDots' in em.get('class', '').split()]:
+            text = markup.text(em, True).strip()
+            em.clear(keep_tail=True)
+            em.set('class', 'dot')
+            em.text = text
 
-        normalize_ruby_emphasis(content)
+        open_tags = set()
+        normalize_ruby_emphasis(content, True, open_tags)
 
-        content = content.decode()
+        content = markup.serialize(content, True, open_tags)
         return content
 
@@ -0,0 +1,222 @@
+from typing import Iterable, List
+
+from bs4.dammit import EncodingDetector
+from lxml import etree
+
+# Episode pages are parsed with lxml directly and written back out exactly like BeautifulSoup's
+# decode() would with the same lxml parser, so stored episodes keep their format. That covers how
+# BeautifulSoup picks the encoding, collapses whitespace-only strings, splits multi-valued HTML
+# attributes and chooses between <x/> and <x></x>. Namespace prefixes are the ones lxml keeps on
+# moved elements, which only differs from BeautifulSoup when the moved parts declare their own.
+
+whitespace = "\x20\x0a\x09\x0c\x0d"
+void_tags = {"area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem", "meta",
+             "param", "source", "track", "wbr", "basefont", "bgsound", "command", "frame", "image", "isindex",
+             "nextid", "spacer"}
+preserve_tags = {"pre", "textarea"}
+# Strings in these tags only show up in the text of the same kind of tag
+string_containers = {"rt", "rp", "style", "script", "template"}
+cdata_tags = {"script", "style"}
+list_attributes = {"class", "accesskey", "dropzone"}
+tag_list_attributes = {
+    "a": {"rel", "rev"},
+    "link": {"rel", "rev"},
+    "td": {"headers"},
+    "th": {"headers"},
+    "form": {"accept-charset"},
+    "object": {"archive"},
+    "area": {"rel"},
+    "icon": {"sizes"},
+    "iframe": {"sandbox"},
+    "output": {"for"},
+}
+xml_namespace = "http://www.w3.org/XML/1998/namespace"
+chunk_size = 512
+
+
+def local(tag) -> str:
+    return tag.rpartition('}')[2] if isinstance(tag, str) else ""
+
+
+def feed(data, encoding, html: bool):
+    parser = (etree.HTMLParser if html else etree.XMLParser)(recover=True, huge_tree=False, encoding=encoding)
+    if html:
+        parser.feed(data)
+    else:
+        for start in range(0, max(len(data), 1), chunk_size):
+            parser.feed(data[start:start + chunk_size])
+    return parser.close()
+
+
+# Tries the encodings BeautifulSoup would, in the same order
+def parse(markup: bytes | str, html: bool) -> etree._Element:
+    if isinstance(markup, str):
+        attempts = [(markup.removeprefix('\N{BYTE ORDER MARK}'), None), (markup.encode(), "utf8")]
+    else:
+        detector = EncodingDetector(markup, is_html=html)
+        attempts = ((detector.markup, encoding) for encoding in detector.encodings)
+    for data, encoding in attempts:
+        try:
+            root = feed(data, encoding, html)
+        except (UnicodeDecodeError, LookupError, etree.ParserError):
+            continue
+        if root is not None:
+            return root
+    raise RuntimeError("Can't parse document")
+
+
+def collapsible(value) -> bool:
+    return value is not None and not value.strip(whitespace)
+
+
+def collapse(value: str) -> str:
+    return "\n" if "\n" in value else " "
+
+
+# Whitespace-only strings become a single newline or space, except inside <pre> and <textarea>
+def collapse_whitespace(root: etree._Element, html: bool):
+    preserved = set()
+    if html:
+        if next(root.iterancestors(*preserve_tags), None) is not None:
+            return
+        for tag in root.iter(*preserve_tags):
+            preserved.update(tag.iter())
+    for element in root.iter():
+        if element.tag is etree.Comment and element.text is None:
+            element.text = " "
+        elif collapsible(element.text) and element not in preserved:
+            element.text = collapse(element.text)
+        if collapsible(element.tail) and element is not root and element.getparent() not in preserved:
+            element.tail = collapse(element.tail)
+
+
+def find_class(root: etree._Element, name: str) -> List[etree._Element]:
+    return [element for element in root.iter()
+            if isinstance(element.tag, str) and name in element.get("class", "").split()]
+
+
+def container(element: etree._Element, html: bool):
+    if html:
+        for ancestor in (element, *element.iterancestors()):
+            if ancestor.tag in string_containers:
+                return ancestor.tag
+    return None
+
+
+# Text of the strings in element, leaving out comments, and in HTML the strings of <rt>, <rp> and
+# other string containers unless element is one of the same kind
+def text(element: etree._Element, html: bool) -> str:
+    wanted = element.tag if html and element.tag in string_containers else None
+    parts = []
+
+    def walk(element, kind):
+        if element.text is not None and kind == wanted:
+            parts.append(element.text)
+        for child in element:
+            if isinstance(child.tag, str):
+                walk(child, child.tag if html and child.tag in string_containers else kind)
+            if child.tail is not None and kind == wanted:
+                parts.append(child.tail)
+
+    walk(element, container(element, html))
+    return "".join(parts)
+
+
+# Strings and elements directly inside element in document order, comments and processing
+# instructions are given as strings as BeautifulSoup treats them as such
+def children(element: etree._Element) -> Iterable[str | etree._Element]:
+    if element.text is not None:
+        yield element.text
+    for child in element:
+        if child.tag is etree.Comment:
+            yield child.text or ""
+        elif child.tag is etree.PI:
+            yield child.target + " " + (child.text or "")
+        else:
+            yield child
+        if child.tail is not None:
+            yield child.tail
+
+
+def escape(value: str) -> str:
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if "<" in value:
+        value = value.replace("<", "&lt;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    return value
+
+
+def quote(value: str) -> str:
+    value = escape(value)
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', "&quot;") + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+
+def qualified(element: etree._Element, key: str) -> str:
+    if key[0] != "{":
+        return key
+    namespace, _, name = key[1:].partition("}")
+    if namespace == xml_namespace:
+        return "xml:" + name
+    for prefix, uri in element.nsmap.items():
+        if uri == namespace and prefix:
+            return prefix + ":" + name
+    return name
+
+
+def attributes(element: etree._Element, name: str, html: bool) -> str:
+    if html and not len(element.attrib):
+        return ""
+    items = []
+    for key, value in element.attrib.items():
+        if html and (key in list_attributes or key in tag_list_attributes.get(name, ())):
+            value = " ".join(value.split())
+        items.append((qualified(element, key), value))
+    if not html:
+        parent = element.getparent()
+        inherited = parent.nsmap if parent is not None else {}
+        for prefix, uri in element.nsmap.items():
+            if inherited.get(prefix) != uri:
+                items.append(("xmlns:" + prefix if prefix else "xmlns", uri))
+    items.sort()
+    return "".join(f" {key}={quote(value)}" for key, value in items)
+
+
+# Renders element like BeautifulSoup's decode(). Tags in open_tags are never written as <x/>, as with
+# tags BeautifulSoup did not create from the parsed document.
+def serialize(element: etree._Element, html: bool, open_tags=frozenset()) -> str:
+    parts = []
+
+    def write(element):
+        tag = element.tag
+        if tag is etree.Comment:
+            parts.append("<!--" + (element.text or "") + "-->")
+        elif tag is etree.PI:
+            parts.append("<?" + element.target + " " + (element.text or "") + (">" if html else "?>"))
+        elif not isinstance(tag, str):
+            parts.append(escape(element.text or ""))
+        else:
+            name = local(tag)
+            if element.prefix:
+                name = element.prefix + ":" + name
+            start = "<" + name + attributes(element, name, html)
+            if element.text is None and not len(element) and element not in open_tags \
+                    and (not html or name in void_tags):
+                parts.append(start + "/>")
+            else:
+                parts.append(start + ">")
+                if element.text is not None:
+                    parts.append(element.text if html and name in cdata_tags else escape(element.text))
+                for child in element:
+                    write(child)
+                    if child.tail is not None:
+                        parts.append(child.tail if html and name in cdata_tags else escape(child.tail))
+                parts.append("</" + name + ">")
+
+    write(element)
+    return "".join(parts)
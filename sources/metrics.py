@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import contextvars
+import json
+import statistics
+import time
+from typing import Dict, List
+
+# Record of the episode (or book metadata) the current task is working on, stages add their time to it
+current: contextvars.ContextVar[dict | None] = contextvars.ContextVar("metrics_record", default=None)
+
+stages = ("queue", "network", "parse", "normalize", "compress", "seconds")
+
+
+def add(name: str, value: float):
+    record = current.get()
+    if record is not None:
+        record[name] = record.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def timed(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(stage, time.perf_counter() - started)
+
+
+def quantile(values: List[float], q: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[round(q * 100) - 1]
+
+
+# Per episode timings of a fetch run: waiting for a slot of the source, network, parse, normalize
+# and compression, with raw and compressed sizes, plus the duration of each database commit.
+# Written at the end of the run as JSON lines or in the Prometheus text format.
+class Metrics:
+    def __init__(self):
+        self.records: List[dict] = []
+
+    @contextlib.contextmanager
+    def record(self, kind: str, source: str, book: str, episode: str = None):
+        record = {"type": kind, "source": source, "book": book}
+        if episode is not None:
+            record["episode"] = episode
+        token = current.set(record)
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - started
+            current.reset(token)
+            self.records.append(record)
+
+    def commit(self, source: str, book: str, rows: int, seconds: float):
+        self.records.append({"type": "commit", "source": source, "book": book, "rows": rows, "seconds": seconds})
+
+    def summary(self) -> Dict[str, dict]:
+        values = collections.defaultdict(lambda: collections.defaultdict(list))
+        sizes = collections.defaultdict(lambda: [0, 0])
+        for record in self.records:
+            source = values[record["source"]]
+            if record["type"] == "episode":
+                for stage in stages:
+                    source["episode" if stage == "seconds" else stage].append(record.get(stage, 0.0))
+                sizes[record["source"]][0] += record.get("bytes_in", 0)
+                sizes[record["source"]][1] += record.get("bytes_out", 0)
+            else:
+                source[record["type"]].append(record["seconds"])
+
+        summary = {}
+        for source, timings in values.items():
+            bytes_in, bytes_out = sizes[source]
+            summary[source] = {
+                "stages": {stage: {"count": len(items), "sum": sum(items),
+                                   "p50": quantile(sorted(items), 0.5), "p99": quantile(sorted(items), 0.99)}
+                           for stage, items in timings.items()},
+                "bytes_in": bytes_in,
+                "bytes_out": bytes_out,
+                "compression_ratio": bytes_in / bytes_out if bytes_out else 0.0,
+            }
+        return summary
+
+    def write(self, path: str):
+        with open(path, "w") as output:
+            if path.endswith(".prom"):
+                output.write(self.prometheus())
+                return
+            for record in self.records:
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.write(json.dumps({"type": "summary", "sources": self.summary()}) + "\n")
+
+    def prometheus(self) -> str:
+        lines = [
+            "# TYPE novel_stage_seconds summary",
+            "# TYPE novel_bytes_total counter",
+            "# TYPE novel_compression_ratio gauge",
+        ]
+        for source, summary in self.summary().items():
+            for stage, values in summary["stages"].items():
+                labels = f'source="{source}",stage="{stage}"'
+                lines.append(f'novel_stage_seconds{{{labels},quantile="0.5"}} {values["p50"]}')
+                lines.append(f'novel_stage_seconds{{{labels},quantile="0.99"}} {values["p99"]}')
+                lines.append(f'novel_stage_seconds_sum{{{labels}}} {values["sum"]}')
+                lines.append(f'novel_stage_seconds_count{{{labels}}} {values["count"]}')
+            lines.append(f'novel_bytes_total{{source="{source}",direction="in"}} {summary["bytes_in"]}')
+            lines.append(f'novel_bytes_total{{source="{source}",direction="out"}} {summary["bytes_out"]}')
+            lines.append(f'novel_compression_ratio{{source="{source}"}} {summary["compression_ratio"]}')
+        return "\n".join(lines) + "\n"
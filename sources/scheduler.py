@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import collections
+import math
+import os
+import sys
+import time
+from typing import Dict
+
+import anyio
+from tqdm import tqdm
+
+from . import metrics
+from .client import clients
+from .throttle import Throttle
+
+
+class Slot:
+    def __init__(self, throttle: Throttle, concurrency: anyio.CapacityLimiter):
+        self.throttle = throttle
+        self.limiter = throttle.limiter
+        self.concurrency = concurrency
+
+    async def __aenter__(self):
+        with metrics.timed("queue"):
+            await self.limiter.acquire()
+            try:
+                await self.concurrency.acquire()
+            except BaseException:
+                self.limiter.release()
+                raise
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.concurrency.release()
+        self.limiter.release()
+
+
+# Every request takes a slot of its source throttle and of the global limiter.
+# Each book only runs as many episode workers as its source allows, so the FIFO limiters
+# interleave books instead of letting one big book queue all of its episodes ahead of the rest.
+class Scheduler:
+    def __init__(self, concurrency=math.inf, limits: Dict[str, float] = None, rates: Dict[str, float] = None,
+                 shared=False):
+        self.concurrency = anyio.CapacityLimiter(concurrency)
+        self.limits = limits or {}
+        self.rates = rates or {}
+        self.throttles: Dict[str, Throttle] = {}
+        self.shared = shared
+        self.cpu = anyio.CapacityLimiter(os.cpu_count() or 1)
+
+        self.progress = None
+        self.retry_count = 0
+        self.finished = collections.deque()
+        self.metrics = metrics.Metrics()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.progress is not None:
+            self.progress.close()
+            self.progress = None
+        await clients.aclose()
+
+    def source_limit(self, fetcher) -> float:
+        return self.limits.get(fetcher.source, fetcher.limit)
+
+    def limiter(self, fetcher) -> Slot:
+        throttle = self.throttles.get(fetcher.source)
+        if throttle is None:
+            throttle = Throttle(self.source_limit(fetcher), self.rates.get(fetcher.source, fetcher.rate))
+            self.throttles[fetcher.source] = throttle
+        return Slot(throttle, self.concurrency)
+
+    def workers(self, fetcher, count: int) -> int:
+        return int(min(count, self.source_limit(fetcher), self.concurrency.total_tokens))
+
+    async def offload(self, func, *args):
+        return await anyio.to_process.run_sync(func, *args, limiter=self.cpu)
+
+    def add(self, count: int):
+        if self.progress is None:
+            self.progress = tqdm(desc="Fetching episodes", total=count, file=sys.stdout)
+        else:
+            self.progress.total += count
+            self.progress.refresh()
+
+    # Episodes per second over the last ten seconds and the current concurrency of each source
+    def status(self):
+        now = time.monotonic()
+        while self.finished and now - self.finished[0] > 10:
+            self.finished.popleft()
+        elapsed = max(1.0, now - self.finished[0]) if self.finished else 10
+        status = {"rate": f"{len(self.finished) / elapsed:.1f}/s"}
+        for source, throttle in self.throttles.items():
+            if throttle.limit != math.inf:
+                status[source] = int(throttle.limit)
+        if self.retry_count:
+            status["retry"] = self.retry_count
+        return status
+
+    def advance(self):
+        self.finished.append(time.monotonic())
+        self.progress.set_postfix(self.status(), refresh=False)
+        self.progress.update()
+
+    def retry(self):
+        self.retry_count += 1
+        if self.progress is not None:
+            self.progress.set_postfix(self.status())
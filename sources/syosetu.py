@@ -1,36 +1,37 @@
-import copy
 from datetime import datetime
+import json
+import pickle
 import re
 import sys
+import time
+from typing import List
 import zoneinfo
 
 import anyio
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
+from lxml import etree
 from tqdm import tqdm
 
 from util import Chapter, Episode
+from . import markup
 from .base import Base
-from .tools import *
-
-
-zygote = BeautifulSoup('<p></p>', 'lxml').find('p')
-
-
-def make_tag(name):
-    tag = copy.copy(zygote)
-    tag.name = name
-    return tag
+from .tools import normalize_ruby_emphasis
 
 
 class Syosetu(Base):
     source = "syosetu"
     zone = zoneinfo.ZoneInfo('Asia/Tokyo')
+    cookies = {'over18': 'yes'}
+    menu_page_size = 100
 
     def __init__(self, book_id, limit=2, tries=3):
         super().__init__(book_id, limit, tries, source_unique_episode_id=True)
 
-        self.client.cookies.update({'over18': 'yes'})
         self.is_r18 = False
+        # Novel API entry of the book, set by probe
+        self.listing = None
+        # Whether fetch_metadata took TOC pages from the stored menu
+        self.reused_menu = False
 
     confident_re = re.compile(r"(https?://)?(ncode|novel18)\.syosetu\.com/(?P<id>n[0-9]{4}[a-z]{1,2})/?")
     maybe_re = re.compile(r"n[0-9]{4}[a-z]{1,2}")
@@ -49,13 +50,55 @@ class Syosetu(Base):
     def site(self):
         return "novel18" if self.is_r18 else "ncode"
 
-    def incremental_parse_syosetu_menu(self, content: BeautifulSoup):
+    # The novel API reports when a book was last updated and its episode count, R18 books are
+    # only listed by the novel18 API.
+    async def probe(self):
+        for api in ("novelapi", "novel18api"):
+            async with self.limiter:
+                page = await self.get_retry(f"https://api.syosetu.com/{api}/api/",
+                                            params={"ncode": self.book_id, "of": "nu-gl-ga", "out": "json"})
+            data = json.loads(page.content)
+            if data[0]['allcount']:
+                self.listing = data[1]
+                return f"{data[1]['novelupdated_at']} {data[1]['general_all_no']}"
+        return None
+
+    # Whether the book only changed by new episodes since the stored menu: the API lists more
+    # episodes, and nothing was updated after the last one was posted. Revisions bump
+    # novelupdated_at past general_lastup, as does anything else done to the book.
+    def only_new_episodes(self, stored_episodes) -> bool:
+        if self.listing is None:
+            return False
+        return self.listing['general_all_no'] > stored_episodes \
+            and self.listing['novelupdated_at'] <= self.listing['general_lastup']
+
+    # Reused TOC pages miss an episode revised shortly before new ones were posted, see
+    # reuse_menu_pages. Once the stored menu was partly reused for longer than full_menu_days, the
+    # whole TOC is loaded again, even when the book looks unchanged.
+    def full_menu_due(self, book) -> bool:
+        return book is not None and book.partial_menu_since is not None \
+            and time.time() - book.partial_menu_since > self.full_menu_days * 86400
+
+    def needs_refresh(self, book) -> bool:
+        return self.full_menu_due(book)
+
+    def fetched(self):
+        book = self.db.find_book(self.book_id, self.source)
+        if not self.reused_menu:
+            if book.partial_menu_since is not None:
+                self.db.update_book_partial_menu(book.id, None)
+        elif book.partial_menu_since is None:
+            self.db.update_book_partial_menu(book.id, int(time.time()))
+
+    @classmethod
+    def parse_menu_items(cls, content: BeautifulSoup) -> List[Chapter | Episode]:
         menu_el = content.select_one('.p-eplist')
         assert menu_el is not None, "Can't find menu"
+        items = []
         for el in menu_el:
             match el:
                 case Tag(attrs={'class': ['p-eplist__chapter-title']}):
-                    self.menu.push_item(Chapter('', el.text, 1))
+                    items.append(Chapter('', el.text, 1))
                 case Tag(attrs={'class': ['p-eplist__sublist']}):
                     link = el.select_one('a')
                     create = el.select_one('.p-eplist__update').text.strip().removesuffix('（改）').strip()
@@ -67,81 +110,155 @@ class Syosetu(Base):
 
                     episode_id = link['href'].split('/')[2]
                     title = link.text.strip()
-                    version = int(datetime.strptime(update, '%Y/%m/%d %H:%M').replace(tzinfo=self.zone).timestamp())
-                    creation = int(datetime.strptime(create, '%Y/%m/%d %H:%M').replace(tzinfo=self.zone).timestamp())
+                    version = int(datetime.strptime(update, '%Y/%m/%d %H:%M').replace(tzinfo=cls.zone).timestamp())
+                    creation = int(datetime.strptime(create, '%Y/%m/%d %H:%M').replace(tzinfo=cls.zone).timestamp())
 
-                    self.menu.push_item(Episode(episode_id, title, version, creation))
+                    items.append(Episode(episode_id, title, version, creation))
+        return items
 
-    async def fetch_metadata_extra(self, page, recv: anyio.Event, send: anyio.Event):
-        async with self.limiter:
-            page = await self.get_retry(f"https://{self.site}.syosetu.com/{self.book_id}/?p={page}")
-        content = BeautifulSoup(page.content, "lxml")
+    # Parsed in worker processes, so only the extracted items come back to the event loop
+
+    @classmethod
+    def parse_menu_first_page(cls, raw: bytes):
+        content = BeautifulSoup(raw, "lxml")
+        title = content.find('title').text.strip()  # <---
+        author = content.select_one('meta[name="twitter:creator"]').attrs['content'].strip()
+        description = content.select_one('#novel_ex').text.strip()
+
+        pages = 1
+        pager = content.select_one('.c-pager__pager')
+        if pager is not None:
+            last = pager.select_one('.c-pager__item--last')
+            pages = int(last['href'].split('?p=')[-1])
+
+        return title, author, description, pages, cls.parse_menu_items(content)
 
-        await recv.wait()
-        self.incremental_parse_syosetu_menu(content)
-        self.progress.update()
-        send.set()
+    @classmethod
+    def parse_menu_page(cls, raw: bytes):
+        return cls.parse_menu_items(BeautifulSoup(raw, "lxml"))
 
     async def fetch_metadata(self):
-        page = await self.get_retry(f"https://{self.site}.syosetu.com/{self.book_id}/")
-        if page.has_redirect_location:
-            assert "novel18" in page.next_request.url.host
-            self.is_r18 = True
-            print(f"R18 book detected.")
-            page = await self.send_retry(page.next_request)
+        async with self.limiter:
+            page = await self.get_retry(f"https://{self.site}.syosetu.com/{self.book_id}/", cache=True)
+            if page.has_redirect_location:
+                assert "novel18" in page.next_request.url.host
+                self.is_r18 = True
+                self.log(f"R18 book detected.")
+                page = await self.send_retry(page.next_request, cache=True)
 
         assert page.is_success, "unexpected redirect"
 
-        content = BeautifulSoup(page.content, "lxml")
-        self.title = content.find('title').text.strip()  # <---
-        self.author = content.select_one('meta[name="twitter:creator"]').attrs['content'].strip()
-        self.description = content.select_one('#novel_ex').text.strip()
-        self.incremental_parse_syosetu_menu(content)
+        self.title, self.author, self.description, pages, items = \
+            await self.scheduler.offload(self.parse_menu_first_page, page.content)
+        self.menu.items.extend(items)
 
-        pager = content.select_one('.c-pager__pager')
-        if pager is not None:
-            last = pager.select_one('.c-pager__item--last')
-            pages = int(last['href'].split('?p=')[-1])
-            print(f"Multi page metadata with {pages} pages.")
+        if pages > 1:
+            self.log(f"Multi page metadata with {pages} pages.")
+
+            first = 2
+            if self.incremental:
+                stored = self.stored_menu_pages()
+                first = self.reuse_menu_pages(stored, pages)
+                if first > 2:
+                    self.log(f"Reusing {first - 2} stored metadata pages.")
 
-            with tqdm(desc="Fetching metadata", total=pages, initial=1, file=sys.stdout) as self.progress:
-                async with anyio.create_task_group() as tg:
-                    recv = anyio.Event()
-                    recv.set()
-                    self.limiter = anyio.CapacityLimiter(self.limit)
+            fetched = await self.fetch_menu_pages(first, pages)
 
-                    for i in range(2, pages + 1):
-                        send = anyio.Event()
-                        tg.start_soon(self.fetch_metadata_extra, i, recv, send)
-                        recv = send
-            self.progress = None
+            # The first refetched page must still start with what was stored for it, otherwise
+            # earlier pages may have shifted as well
+            if first > 2 and fetched[0][:len(stored[first - 1])] != stored[first - 1]:
+                self.log(f"Stored metadata is outdated, fetching all pages.")
+                del self.menu.items[len(stored[0]):]
+                fetched = await self.fetch_menu_pages(2, pages)
+                first = 2
+            self.reused_menu = first > 2
+
+            for items in fetched:
+                self.menu.items.extend(items)
+
+    # Pages are downloaded and parsed concurrently, then returned in page order
+    async def fetch_menu_pages(self, first, pages) -> List[List[Chapter | Episode]]:
+        fetched = [[] for _ in range(first, pages + 1)]
+
+        async def fetch_page(index, progress: tqdm):
+            async with self.limiter:
+                page = await self.get_retry(f"https://{self.site}.syosetu.com/{self.book_id}/?p={index}", cache=True)
+            fetched[index - first] = await self.scheduler.offload(self.parse_menu_page, page.content)
+            progress.update()
+
+        with tqdm(desc="Fetching metadata", total=pages, initial=first - 1, file=sys.stdout,
+                  disable=self.scheduler.shared) as progress:
+            async with anyio.create_task_group() as tg:
+                for i in range(first, pages + 1):
+                    tg.start_soon(fetch_page, i, progress)
+
+        return fetched
+
+    # Items of the stored menu split by the TOC page they were listed on
+    def stored_menu_pages(self) -> List[List[Chapter | Episode]]:
+        book = self.db.find_book(self.book_id, self.source)
+        if book is None:
+            return []
+        stored = []
+        episodes = 0
+        for item in pickle.loads(book.menu).items:
+            page = episodes // self.menu_page_size
+            if isinstance(item, Episode):
+                episodes += 1
+            while len(stored) <= page:
+                stored.append([])
+            stored[page].append(item)
+        return stored
+
+    # New episodes only show up at the end of the TOC, so when the book only got new episodes and the
+    # first page is unchanged, the pages before the last stored one are taken from the stored menu.
+    # Otherwise episodes may have been revised anywhere and every page is fetched. A revision made
+    # before new episodes were posted, within the same update interval, still looks like new episodes
+    # only, so the whole TOC is also fetched once the menu was partly reused for full_menu_days.
+    # Returns the first page to fetch.
+    def reuse_menu_pages(self, stored, pages) -> int:
+        if len(stored) <= 2 or len(stored) > pages or stored[0] != self.menu.items:
+            return 2
+        if self.full_menu_due(self.db.find_book(self.book_id, self.source)):
+            self.log(f"Stored metadata was reused for {self.full_menu_days:g} days, fetching all pages.")
+            return 2
+        if not self.only_new_episodes(sum(isinstance(item, Episode) for items in stored for item in items)):
+            return 2
+        for items in stored[1:-1]:
+            self.menu.items.extend(items)
+        return len(stored)
 
     async def fetch_episode(self, episode: Episode):
         async with self.limiter:
             page = await self.get_retry(f"https://{self.site}.syosetu.com/{self.book_id}/{episode.id}/")
+        return page.content
 
-        content = BeautifulSoup(page.content, "lxml-xml")
-        contents = content.select(".p-novel__text")
+    @classmethod
+    def parse_episode(cls, raw):
+        document = markup.parse(raw, html=False)
+        contents = markup.find_class(document, "p-novel__text")
         if not contents:
             raise RuntimeError("Can't find content")
+        for part in contents:
+            markup.collapse_whitespace(part, html=False)
         content = contents[0]
+        open_tags = set()
         for extra in contents[1:]:
-            separator = make_tag('p')
-            separator.attrs = {'class': 'split'}
-            separator.append(make_tag('hr'))
-            content.append(separator)
-            content.extend(extra)
+            separator = etree.SubElement(content, 'p', {'class': 'split'})
+            open_tags.add(etree.SubElement(separator, 'hr'))
+            separator.tail, extra.text = extra.text, None
+            content.extend(list(extra))
 
-        content.attrs = {'class': 'content'}
+        content.attrib.clear()
+        content.set('class', 'content')
 
         # clean id on <p> and mark blank element
-        for p in content.select('p'):
-            if 'id' in p.attrs:
-                del p.attrs['id']
-            if all(isinstance(t, Tag) and t.name == 'br' for t in p):
-                p.attrs['class'] = 'blank'
+        for p in content.iter('{*}p'):
+            p.attrib.pop('id', None)
+            if p.text is None and all(markup.local(t.tag) == 'br' and t.tail is None for t in p):
+                p.set('class', 'blank')
 
-        normalize_ruby_emphasis(content)
+        normalize_ruby_emphasis(content, False, open_tags)
 
-        content = content.decode()
+        content = markup.serialize(content, False, open_tags)
         return content
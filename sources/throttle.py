@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import email.utils
+import math
+import random
+import time
+
+import anyio
+import httpx
+
+
+def retry_after(response: httpx.Response | None) -> float | None:
+    value = None if response is None else response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base=1.0, cap=30.0) -> float:
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TokenBucket:
+    def __init__(self, rate=math.inf, burst=1.0):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        if self.rate == math.inf:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await anyio.sleep((1 - self.tokens) / self.rate)
+
+
+# Per source request throttle. Concurrency follows AIMD: it grows by one slot after a window of
+# successful requests, up to the configured limit, and is halved on errors, timeouts or when the
+# average latency climbs well above the best seen. Requests also pass a token bucket and wait out
+# any Retry-After the server asked for.
+class Throttle:
+    def __init__(self, limit: float, rate=math.inf):
+        self.ceiling = limit
+        self.limiter = anyio.CapacityLimiter(limit)
+        self.bucket = TokenBucket(rate, burst=rate if rate != math.inf else 1)
+        self.paused_until = 0.0
+
+        self.latency = None
+        self.best_latency = math.inf
+        self.successes = 0
+        self.decreased_at = 0.0
+
+    @property
+    def limit(self) -> float:
+        return self.limiter.total_tokens
+
+    async def wait(self):
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await anyio.sleep(pause)
+        await self.bucket.acquire()
+
+    def success(self, latency: float):
+        self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+        self.best_latency = min(self.best_latency, self.latency)
+        if self.latency > self.best_latency * 4:
+            self.decrease()
+            return
+
+        self.successes += 1
+        if self.limit < self.ceiling and self.successes >= self.limit:
+            self.successes = 0
+            self.limiter.total_tokens = self.limit + 1
+
+    def failure(self, delay: float | None = None):
+        if delay is not None:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.decrease()
+
+    def decrease(self):
+        now = time.monotonic()
+        # One decrease per round trip, requests already in flight report the same congestion
+        if now - self.decreased_at < (self.latency or 1.0):
+            return
+        self.decreased_at = now
+        self.successes = 0
+        current = self.limit if self.limit != math.inf else self.limiter.borrowed_tokens
+        self.limiter.total_tokens = max(1, int(current // 2))
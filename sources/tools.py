@@ -1,15 +1,18 @@
-from bs4 import NavigableString, Tag
+from lxml import etree
 
+from . import markup
 
-# normalize ruby based emphasis
-def normalize_ruby_emphasis(content: Tag):
-    for em_ruby in content.select('ruby'):
-        rts = em_ruby.select('rt')
-        if not all(all(char == '・' for char in rt.text) for rt in rts):
+
+# normalize ruby based emphasis, the <em> replacing a ruby is added to open_tags
+def normalize_ruby_emphasis(content: etree._Element, html: bool, open_tags: set):
+    for em_ruby in list(content.iter('{*}ruby')):
+        rts = em_ruby.iter('{*}rt')
+        if not all(all(char == '・' for char in markup.text(rt, html)) for rt in rts):
             continue
 
-        base = ''.join(part.strip() for part in em_ruby if isinstance(part, NavigableString))
-        em_ruby.attrs = {'class': 'dot'}
-        em_ruby.name = 'em'
-        em_ruby.clear(True)
-        em_ruby.append(NavigableString(base))
+        base = ''.join(part.strip() for part in markup.children(em_ruby) if isinstance(part, str))
+        em_ruby.clear(keep_tail=True)
+        em_ruby.tag = 'em'
+        em_ruby.set('class', 'dot')
+        em_ruby.text = base
+        open_tags.add(em_ruby)
@@ -1,3 +1,4 @@
-from .db import NovelDB
+from .db import NovelDB, zstd_compress
+from .epub import EpubWriter, TocEntry
 from .menu import Chapter, NChapter, Episode, Menu, LinearMenu
 from .meta import make_track_sub_meta
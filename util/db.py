@@ -1,10 +1,15 @@
 import functools
-import inspect
+import hashlib
+import json
 import sqlite3
+import time
+import types
 from collections import namedtuple
 
 import zstandard
 
+from .schema import latest_version, pragmas, schema_version
+
 
 @functools.cache
 def cached_namedtuple(field_names):
@@ -17,61 +22,145 @@ def namedtuple_factory(cursor, row):
     return cls._make(row)
 
 
+# Row whose content is decompressed on first access and then cached on the row
+@functools.cache
+def lazy_namedtuple(field_names, category):
+    index = field_names.index("content")
+
+    class LazyRow(cached_namedtuple(field_names)):
+        @functools.cached_property
+        def content(self):
+            data = self[index]
+            return None if data is None else decompress_stored(data, getattr(self, 'delta_base', None), category)
+
+    return LazyRow
+
+
+def select_columns(columns, table=None):
+    prefix = "" if table is None else f"{table}."
+    if columns is None:
+        return f"{prefix}*"
+    if not all(column.isidentifier() for column in columns):
+        raise ValueError(f"Bad columns {columns}")
+    # Delta compressed content can't be read without its base
+    if "content" in columns and "delta_base" not in columns:
+        columns = (*columns, "delta_base")
+    return ", ".join(prefix + column for column in columns)
+
+
 _compress_dict: dict[str, str] = {
     "episode": "episode.dict",
     "episode_ruby": "episode_ruby.dict"
 }
-_compress_ctx: dict[str, zstandard.ZstdCompressor] = {}
-_decompress_ctx: dict[str, zstandard.ZstdDecompressor] = {}
+_compress_ctx: dict[tuple, zstandard.ZstdCompressor] = {}
+_decompress_ctx: dict[int, zstandard.ZstdDecompressor] = {}
+# Episodes are compressed fast on ingest, the compact command brings them to the full level later
 compression_level = 18
+ingest_compression_level = 3
+
+
+def file_dict(category: str):
+    with open(_compress_dict[category], "rb") as d:
+        return zstandard.ZstdCompressionDict(d.read())
+
+
+# Dictionaries trained by the train command are stored in the database, the newest one of a category
+# is used for compression. The shipped dictionary files are used until one has been trained.
+def current_dict(category: str):
+    data = NovelDB().find_dict(category)
+    if data is None:
+        return file_dict(category)
+    return zstandard.ZstdCompressionDict(data)
+
+
+# Id and data of the current dictionary, resolved once by the parent and handed to worker processes
+# so they compress with the same dictionary for the whole run and never open the database
+def dict_payload(category: str) -> tuple[int, bytes]:
+    dictionary = current_dict(category)
+    return dictionary.dict_id(), dictionary.as_bytes()
+
 
+def find_dict(dict_id: int, category: str):
+    episode_dict = file_dict(category)
+    if episode_dict.dict_id() == dict_id:
+        return episode_dict
+    data = NovelDB().find_dict_by_id(dict_id)
+    if data is None:
+        raise KeyError(f"Unknown zstd dictionary {dict_id}")
+    return zstandard.ZstdCompressionDict(data)
 
-def zstd_compress(data: str, category: str):
+
+def reset_compressor(category: str):
+    for key in [key for key in _compress_ctx if key[0] == category]:
+        del _compress_ctx[key]
+
+
+def frame_dict_id(data: bytes) -> int:
+    return zstandard.get_frame_parameters(data).dict_id
+
+
+# Compresses with the given dict_payload, or else with the current dictionary of the category
+def zstd_compress(data: str, category: str, level=compression_level, dictionary: tuple[int, bytes] = None):
     global _compress_ctx
-    cctx = _compress_ctx.get(category)
+    key = (category, level) if dictionary is None else (category, level, dictionary[0])
+    cctx = _compress_ctx.get(key)
     if cctx is None:
-        with open(_compress_dict[category], "rb") as d:
-            episode_dict = zstandard.ZstdCompressionDict(d.read())
         cctx = zstandard.ZstdCompressor(
-            level=compression_level,
-            dict_data=episode_dict,
+            level=level,
+            dict_data=current_dict(category) if dictionary is None else zstandard.ZstdCompressionDict(dictionary[1]),
             write_checksum=True,
             write_content_size=True,
             write_dict_id=True,
         )
-        _compress_ctx[category] = cctx
+        _compress_ctx[key] = cctx
 
     return cctx.compress(data.encode(encoding="utf-8"))
 
 
+# Rows compressed with different dictionaries coexist, the frame header tells which one to use
 def zstd_decompress(data: bytes, category: str):
     global _decompress_ctx
-    dctx = _decompress_ctx.get(category)
+    dict_id = frame_dict_id(data)
+    dctx = _decompress_ctx.get(dict_id)
     if dctx is None:
-        with open(_compress_dict[category], "rb") as d:
-            episode_dict = zstandard.ZstdCompressionDict(d.read())
-        dctx = zstandard.ZstdDecompressor(
-            dict_data=episode_dict,
-        )
-        _decompress_ctx[category] = dctx
+        if dict_id == 0:
+            dctx = zstandard.ZstdDecompressor()
+        else:
+            dctx = zstandard.ZstdDecompressor(dict_data=find_dict(dict_id, category))
+        _decompress_ctx[dict_id] = dctx
 
     return dctx.decompress(data).decode('utf-8')
 
 
-def compress_content(category: str):
-    def decorator(func):
-        sign = inspect.signature(func)
+# Old versions can be stored as a delta against the next newer version, used as a raw content dictionary
+def zstd_delta_compress(data: str, base: str):
+    cctx = zstandard.ZstdCompressor(
+        level=compression_level,
+        dict_data=zstandard.ZstdCompressionDict(base.encode(encoding="utf-8"),
+                                                dict_type=zstandard.DICT_TYPE_RAWCONTENT),
+        write_checksum=True,
+        write_content_size=True,
+    )
+    return cctx.compress(data.encode(encoding="utf-8"))
 
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            binded = sign.bind(*args, **kwargs)
-            content = binded.arguments["content"]
-            binded.arguments["content"] = zstd_compress(content, category)
-            return func(*binded.args, **binded.kwargs)
 
-        return wrapper
+def zstd_delta_decompress(data: bytes, base: str):
+    dctx = zstandard.ZstdDecompressor(
+        dict_data=zstandard.ZstdCompressionDict(base.encode(encoding="utf-8"),
+                                                dict_type=zstandard.DICT_TYPE_RAWCONTENT),
+    )
+    return dctx.decompress(data).decode('utf-8')
 
-    return decorator
+
+def decompress_stored(data: bytes, delta_base, category: str):
+    if delta_base is None:
+        return zstd_decompress(data, category)
+    base = NovelDB().find_content(category, delta_base)
+    return zstd_delta_decompress(data, decompress_stored(base.content, base.delta_base, category))
+
+
+def content_digest(data: str) -> bytes:
+    return hashlib.blake2b(data.encode(encoding="utf-8"), digest_size=16).digest()
 
 
 def decompress_content(category: str):
@@ -80,9 +169,10 @@ def decompress_content(category: str):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             def decompress_row(row):
-                if row and hasattr(row, 'content') and row.content is not None:
+                # noinspection PyProtectedMember
+                if row and 'content' in row._fields:
                     # noinspection PyProtectedMember
-                    return row._replace(content=zstd_decompress(row.content, category))
+                    return lazy_namedtuple(row._fields, category)._make(row)
                 return row
 
             result = func(*args, **kwargs)
@@ -90,6 +180,8 @@ def decompress_content(category: str):
                 return None
             if isinstance(result, list):
                 return [decompress_row(r) for r in result]
+            if isinstance(result, types.GeneratorType):
+                return (decompress_row(r) for r in result)
             return decompress_row(result)
 
         return wrapper
@@ -97,14 +189,64 @@ def decompress_content(category: str):
     return decorator
 
 
+class EpisodeWriter:
+    # Buffered rows are committed in a single transaction, an interrupted run loses at most the
+    # unflushed episodes, which are fetched again next time as their versions are not recorded.
+    # Content given as bytes must already be compressed at the writer's level, with its digest given.
+    def __init__(self, db: 'NovelDB', table: str, batch=64, interval=2.0, level=ingest_compression_level,
+                 observer=None):
+        self.db = db
+        self.table = table
+        self.level = level
+        # Called with the row count and duration of each commit
+        self.observer = observer
+        self.batch = batch
+        self.interval = interval
+        self.rows = []
+        self.started = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def add(self, book_id, source_id, title, content, version, creation, digest=None):
+        if isinstance(content, str):
+            digest = content_digest(content)
+            content = zstd_compress(content, self.table, self.level)
+        if not self.rows:
+            self.started = time.monotonic()
+        self.rows.append((book_id, source_id, title, content, version, creation, self.level, digest))
+        if len(self.rows) >= self.batch or time.monotonic() - self.started >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        started = time.perf_counter()
+        self.db.add_rows(self.table, rows)
+        if self.observer is not None:
+            self.observer(len(rows), time.perf_counter() - started)
+
+
 class NovelDB:
     _db: sqlite3.Connection = None
 
     @classmethod
     def _get_db(cls):
         if cls._db is None:
-            cls._db = sqlite3.connect("novel.db")
-            cls._db.row_factory = namedtuple_factory
+            db = sqlite3.connect("novel.db", cached_statements=256)
+            version = schema_version(db)
+            if version != latest_version:
+                db.close()
+                raise RuntimeError(f"Database schema is at version {version}, run init to migrate it "
+                                   f"to version {latest_version}")
+            for pragma in pragmas:
+                db.execute(pragma)
+            db.row_factory = namedtuple_factory
+            cls._db = db
 
         return cls._db
 
@@ -118,6 +260,13 @@ class NovelDB:
     def vacuum(self):
         self.db.execute("VACUUM")
 
+    # Iterate with a cursor of its own, so other queries can run while the rows are consumed
+    def stream(self, query, parameters, chunk=64):
+        cur = self.db.cursor()
+        cur.execute(query, parameters)
+        while rows := cur.fetchmany(chunk):
+            yield from rows
+
     # Book management
 
     def add_book(self, source_id, source, title, author, description, menu):
@@ -149,6 +298,14 @@ class NovelDB:
                          (title, author, description, menu, old_data, book_id))
         self.db.commit()
 
+    def update_book_freshness(self, book_id, freshness):
+        self.cur.execute("UPDATE book SET freshness = ? WHERE id == ?", (freshness, book_id))
+        self.db.commit()
+
+    def update_book_partial_menu(self, book_id, since):
+        self.cur.execute("UPDATE book SET partial_menu_since = ? WHERE id == ?", (since, book_id))
+        self.db.commit()
+
     def findall_book(self):
         self.cur.execute("SELECT source, source_id FROM book")
         books = self.cur.fetchall()
@@ -158,19 +315,40 @@ class NovelDB:
         self.cur.execute("DELETE FROM book WHERE id == ?", (book_id,))
         self.db.commit()
 
+    # Episode writing
+
+    # A new version with the same content as the latest one only updates its metadata
+    # Rows are written in order, so a later row for the same episode in the batch supersedes the
+    # earlier one like it would across batches
+    def add_rows(self, table, rows):
+        with self.db:
+            for row in rows:
+                book_id, source_id, title, _, version, creation, _, digest = row
+                self.cur.execute(f"SELECT id, digest FROM {table} "
+                                 "WHERE book_id == ? AND source_id == ? AND latest == TRUE",
+                                 (book_id, source_id))
+                latest = self.cur.fetchone()
+                if latest is not None and digest is not None and latest.digest == digest:
+                    self.cur.execute(f"UPDATE {table} SET title = ?, version = ?, creation = ? WHERE id == ?",
+                                     (title, version, creation, latest.id))
+                    continue
+                if latest is not None:
+                    self.cur.execute(f"UPDATE {table} SET latest = FALSE WHERE book_id == ? AND source_id == ?",
+                                     (book_id, source_id))
+                self.cur.execute(f"INSERT INTO "
+                                 f"{table}(book_id, source_id, title, content, version, creation, compression, "
+                                 "digest, latest) "
+                                 "VALUES(?, ?, ?, ?, ?, ?, ?, ?, TRUE)",
+                                 row)
+
+    def writer(self, table, batch=64, interval=2.0, level=ingest_compression_level, observer=None):
+        return EpisodeWriter(self, table, batch, interval, level, observer)
+
     # Episode management
 
-    @compress_content("episode")
     def add_episode(self, book_id, source_id, title, content, version, creation):
-        self.cur.execute("UPDATE episode "
-                         "SET latest = FALSE "
-                         "WHERE book_id == ? AND source_id == ?",
-                         (book_id, source_id))
-        self.cur.execute("INSERT INTO "
-                         "episode(book_id, source_id, title, content, version, creation, latest) "
-                         "VALUES(?, ?, ?, ?, ?, ?, TRUE)",
-                         (book_id, source_id, title, content, version, creation))
-        self.db.commit()
+        with self.writer("episode", level=compression_level) as writer:
+            writer.add(book_id, source_id, title, content, version, creation)
 
     def findall_episode_meta(self, book_id):
         self.cur.execute("SELECT source_id, version FROM episode "
@@ -180,22 +358,28 @@ class NovelDB:
         return episodes
 
     @decompress_content("episode")
-    def findall_episode(self, book_id):
-        self.cur.execute("SELECT * FROM episode WHERE book_id == ? AND latest == TRUE",
+    def findall_episode(self, book_id, columns=None):
+        self.cur.execute(f"SELECT {select_columns(columns)} FROM episode WHERE book_id == ? AND latest == TRUE",
                          (book_id,))
         episodes = self.cur.fetchall()
         return episodes
 
     @decompress_content("episode")
-    def find_episode(self, book_id, source_id):
-        self.cur.execute("SELECT * FROM episode WHERE book_id == ? AND source_id == ? AND latest == TRUE",
+    def iter_episode(self, book_id, columns=None, chunk=64):
+        return self.stream(f"SELECT {select_columns(columns)} FROM episode WHERE book_id == ? AND latest == TRUE",
+                           (book_id,), chunk)
+
+    @decompress_content("episode")
+    def find_episode(self, book_id, source_id, columns=None):
+        self.cur.execute(f"SELECT {select_columns(columns)} FROM episode "
+                         "WHERE book_id == ? AND source_id == ? AND latest == TRUE",
                          (book_id, source_id))
         episode = self.cur.fetchone()
         return episode
 
     @decompress_content("episode")
-    def findall_one_episode(self, book_id, source_id):
-        self.cur.execute("SELECT * FROM episode WHERE book_id == ? AND source_id == ?",
+    def findall_one_episode(self, book_id, source_id, columns=None):
+        self.cur.execute(f"SELECT {select_columns(columns)} FROM episode WHERE book_id == ? AND source_id == ?",
                          (book_id, source_id))
         episodes = self.cur.fetchall()
         return episodes
@@ -206,36 +390,122 @@ class NovelDB:
 
     # Episode ruby management
 
-    @compress_content("episode_ruby")
     def add_rubified(self, book_id, source_id, title, content, version, creation):
-        self.cur.execute("UPDATE episode_ruby "
-                         "SET latest = FALSE "
-                         "WHERE book_id == ? AND source_id == ?",
-                         (book_id, source_id))
-        self.cur.execute("INSERT INTO "
-                         "episode_ruby(book_id, source_id, title, content, version, creation, latest) "
-                         "VALUES(?, ?, ?, ?, ?, ?, TRUE)",
-                         (book_id, source_id, title, content, version, creation))
-        self.db.commit()
+        with self.writer("episode_ruby", level=compression_level) as writer:
+            writer.add(book_id, source_id, title, content, version, creation)
 
     @decompress_content("episode_ruby")
-    def findall_rubified(self, book_id):
-        self.cur.execute("SELECT * FROM episode_ruby WHERE book_id == ? AND latest == TRUE",
+    def findall_rubified(self, book_id, columns=None):
+        self.cur.execute(f"SELECT {select_columns(columns)} FROM episode_ruby WHERE book_id == ? AND latest == TRUE",
                          (book_id,))
         episodes = self.cur.fetchall()
         return episodes
 
-    def findall_episode_rubified_stale(self, book_id):
-        self.cur.execute("SELECT vanilla.source_id FROM "
-                         "(SELECT * FROM episode WHERE book_id == ? AND latest == true) AS vanilla "
-                         "LEFT JOIN "
-                         "(SELECT * FROM episode_ruby WHERE book_id == ? AND latest == true) AS rubified "
-                         "ON vanilla.source_id == rubified.source_id "
-                         "WHERE rubified.version IS NULL OR vanilla.version > rubified.version"
-                         , (book_id, book_id))
+    @decompress_content("episode_ruby")
+    def iter_rubified(self, book_id, columns=None, chunk=64):
+        return self.stream(f"SELECT {select_columns(columns)} FROM episode_ruby WHERE book_id == ? AND latest == TRUE",
+                           (book_id,), chunk)
+
+    @staticmethod
+    def _rubified_stale_query(columns):
+        return (f"SELECT {select_columns(columns, 'vanilla')} FROM "
+                "(SELECT * FROM episode WHERE book_id == ? AND latest == true) AS vanilla "
+                "LEFT JOIN "
+                "(SELECT * FROM episode_ruby WHERE book_id == ? AND latest == true) AS rubified "
+                "ON vanilla.source_id == rubified.source_id "
+                "WHERE rubified.version IS NULL OR vanilla.version > rubified.version "
+                "ORDER BY vanilla.id")
+
+    @decompress_content("episode")
+    def findall_episode_rubified_stale(self, book_id, columns=None):
+        self.cur.execute(self._rubified_stale_query(columns), (book_id, book_id))
         episodes = self.cur.fetchall()
         return episodes
 
+    @decompress_content("episode")
+    def iter_episode_rubified_stale(self, book_id, columns=None, chunk=64):
+        return self.stream(self._rubified_stale_query(columns), (book_id, book_id), chunk)
+
     def remove_rubified(self, book_id):
         self.cur.execute("DELETE FROM episode_ruby WHERE book_id == ?", (book_id,))
         self.db.commit()
+
+    # Compression dictionary management
+
+    def find_dict(self, category):
+        self.cur.execute("SELECT data FROM compress_dict WHERE category == ? ORDER BY version DESC LIMIT 1",
+                         (category,))
+        row = self.cur.fetchone()
+        return None if row is None else row.data
+
+    def find_dict_by_id(self, dict_id):
+        self.cur.execute("SELECT data FROM compress_dict WHERE dict_id == ?", (dict_id,))
+        row = self.cur.fetchone()
+        return None if row is None else row.data
+
+    # A dictionary stored before is moved to the newest version, making it the current one again
+    def add_dict(self, category, dict_id, data):
+        self.cur.execute("INSERT OR REPLACE INTO compress_dict(dict_id, category, data) VALUES(?, ?, ?)",
+                         (dict_id, category, data))
+        self.db.commit()
+
+    def sample_content(self, table, source, count):
+        self.cur.execute(f"SELECT {table}.content FROM {table} JOIN book ON {table}.book_id == book.id "
+                         f"WHERE book.source == ? AND {table}.latest == TRUE ORDER BY random() LIMIT ?",
+                         (source, count))
+        return [row.content for row in self.cur.fetchall()]
+
+    # Delta rows are left alone, they don't use the shared dictionaries
+    def iter_content(self, table, below_level=None, chunk=256):
+        if below_level is None:
+            return self.stream(f"SELECT id, content FROM {table} WHERE delta_base IS NULL", (), chunk)
+        return self.stream(f"SELECT id, content FROM {table} "
+                           "WHERE delta_base IS NULL AND (compression IS NULL OR compression < ?)",
+                           (below_level,), chunk)
+
+    def count_content(self, table, below_level):
+        self.cur.execute(f"SELECT count(*) AS count FROM {table} "
+                         "WHERE delta_base IS NULL AND (compression IS NULL OR compression < ?)",
+                         (below_level,))
+        return self.cur.fetchone().count
+
+    def find_content(self, table, row_id):
+        self.cur.execute(f"SELECT content, delta_base FROM {table} WHERE id == ?", (row_id,))
+        return self.cur.fetchone()
+
+    def iter_history(self, table, chunk=256):
+        return self.stream(f"SELECT old.id, old.content, "
+                           f"(SELECT min(new.id) FROM {table} AS new "
+                           " WHERE new.book_id == old.book_id AND new.source_id == old.source_id AND new.id > old.id"
+                           ") AS newer "
+                           f"FROM {table} AS old WHERE old.latest == FALSE AND old.delta_base IS NULL",
+                           (), chunk)
+
+    def update_delta(self, table, rows):
+        with self.db:
+            self.cur.executemany(f"UPDATE {table} SET content = ?, delta_base = ? WHERE id == ?", rows)
+
+    def update_content(self, table, rows, level=compression_level):
+        with self.db:
+            self.cur.executemany(f"UPDATE {table} SET content = ?, compression = ? WHERE id == ?",
+                                 [(content, level, row_id) for content, row_id in rows])
+
+    # Ruby cache management
+
+    def findall_ruby_cache(self, book_id):
+        self.cur.execute("SELECT surface, reading, segments FROM ruby_cache WHERE book_id == ?",
+                         (book_id,))
+        return {(row.surface, row.reading): tuple(segment if isinstance(segment, str) else tuple(segment)
+                                                  for segment in json.loads(row.segments))
+                for row in self.cur.fetchall()}
+
+    def add_ruby_cache(self, book_id, entries):
+        with self.db:
+            self.cur.executemany("INSERT OR REPLACE INTO ruby_cache(book_id, surface, reading, segments) "
+                                 "VALUES(?, ?, ?, ?)",
+                                 [(book_id, surface, reading, json.dumps(segments, ensure_ascii=False))
+                                  for (surface, reading), segments in entries.items()])
+
+    def remove_ruby_cache(self, book_id):
+        self.cur.execute("DELETE FROM ruby_cache WHERE book_id == ?", (book_id,))
+        self.db.commit()
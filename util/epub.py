@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import copy
+import datetime
+import os
+import struct
+import time
+import zipfile
+from dataclasses import dataclass, field
+from html import escape
+from typing import List, Optional
+
+container_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+page_template = """<?xml version='1.0' encoding='utf-8'?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{lang}" xml:lang="{lang}">
+<head>
+<title>{title}</title>
+{links}
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+
+@dataclass
+class TocEntry:
+    title: str
+    href: Optional[str] = None
+    children: List[TocEntry] = field(default_factory=list)
+
+    @property
+    def target(self):
+        if self.href is not None:
+            return self.href
+        for child in self.children:
+            if child.target is not None:
+                return child.target
+        return None
+
+
+# Writes pages straight into the zip as they are added in any order, only the manifest is kept in
+# memory until the package document, nav and ncx are written by finish() following the toc order.
+# Pages carry a caller provided key in their zip entry comment. When rebuilding, pages whose key
+# is unchanged are copied from the previous file as is, without rendering or recompressing them.
+class EpubWriter:
+    def __init__(self, path, identifier, title, author, description, lang='ja', incremental=True):
+        self.path = path
+        self.identifier = identifier
+        self.title = title
+        self.author = author
+        self.description = description
+        self.lang = lang
+
+        self.manifest = []
+        self.pages = {}
+        self.styles = []
+
+        self.previous = None
+        self.reused = 0
+        if incremental and os.path.exists(path):
+            try:
+                self.previous = zipfile.ZipFile(path, 'r')
+            except zipfile.BadZipFile:
+                pass
+
+        self.zip = zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_DEFLATED)
+        self.zip.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr('META-INF/container.xml', container_xml)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.zip.close()
+        if self.previous is not None:
+            self.previous.close()
+        if exc_type is None:
+            os.replace(self.path + '.tmp', self.path)
+        else:
+            os.remove(self.path + '.tmp')
+
+    def write_item(self, uid, href, media_type, content: bytes | str, properties=None, key=''):
+        info = zipfile.ZipInfo(f'EPUB/{href}', time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o600 << 16
+        info.comment = key.encode()
+        self.zip.writestr(info, content)
+        self.manifest.append((uid, href, media_type, properties))
+
+    # zipfile has no API to copy an entry without recompressing it, so copy the local header and
+    # compressed data by hand and register the entry the same way ZipFile.writestr() does.
+    def copy_raw(self, info: zipfile.ZipInfo):
+        source = self.previous.fp
+        source.seek(info.header_offset)
+        header = source.read(zipfile.sizeFileHeader)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        source.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+        data = source.read(info.compress_size)
+
+        entry = copy.copy(info)
+        entry.flag_bits &= ~0x08
+        entry.header_offset = self.zip.fp.tell()
+        self.zip.fp.write(entry.FileHeader())
+        self.zip.fp.write(data)
+        self.zip.start_dir = self.zip.fp.tell()
+        self.zip.filelist.append(entry)
+        self.zip.NameToInfo[entry.filename] = entry
+
+    def reuse_page(self, href, key) -> bool:
+        if self.previous is None:
+            return False
+        try:
+            info = self.previous.getinfo(f'EPUB/{href}')
+        except KeyError:
+            return False
+        if info.comment != key.encode():
+            return False
+
+        uid = f'page_{len(self.pages)}'
+        self.copy_raw(info)
+        self.manifest.append((uid, href, 'application/xhtml+xml', None))
+        self.pages[href] = uid
+        self.reused += 1
+        return True
+
+    def add_style(self, uid, href, content):
+        self.write_item(uid, href, 'text/css', content)
+        self.styles.append(href)
+
+    def render_page(self, title, body):
+        links = '\n'.join(f'<link href="{escape(href)}" rel="stylesheet" type="text/css"/>' for href in self.styles)
+        return page_template.format(lang=self.lang, title=escape(title), links=links, body=body)
+
+    def add_page(self, href, title, body, key=''):
+        uid = f'page_{len(self.pages)}'
+        self.write_item(uid, href, 'application/xhtml+xml', self.render_page(title, body), key=key)
+        self.pages[href] = uid
+
+    def render_nav(self, toc: List[TocEntry]):
+        def render(entries):
+            items = []
+            for entry in entries:
+                if entry.href is not None:
+                    label = f'<a href="{escape(entry.href)}">{escape(entry.title)}</a>'
+                else:
+                    label = f'<span>{escape(entry.title)}</span>'
+                if entry.children:
+                    label += render(entry.children)
+                items.append(f'<li>{label}</li>')
+            return f'<ol>{"".join(items)}</ol>'
+
+        body = f'<nav epub:type="toc" id="toc" role="doc-toc"><h2>{escape(self.title)}</h2>{render(toc)}</nav>'
+        return page_template.format(lang=self.lang, title=escape(self.title), links='', body=body)
+
+    def render_ncx(self, toc: List[TocEntry]):
+        counter = 0
+
+        def render(entries):
+            nonlocal counter
+            points = []
+            for entry in entries:
+                counter += 1
+                points.append(f'<navPoint id="navpoint_{counter}">'
+                              f'<navLabel><text>{escape(entry.title)}</text></navLabel>'
+                              f'<content src="{escape(entry.target or "nav.xhtml")}"/>'
+                              f'{render(entry.children)}</navPoint>')
+            return ''.join(points)
+
+        return ("<?xml version='1.0' encoding='utf-8'?>\n"
+                '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1"><head>'
+                f'<meta content="{escape(self.identifier)}" name="dtb:uid"/>'
+                '<meta content="0" name="dtb:depth"/>'
+                '<meta content="0" name="dtb:totalPageCount"/>'
+                '<meta content="0" name="dtb:maxPageNumber"/>'
+                f'</head><docTitle><text>{escape(self.title)}</text></docTitle>'
+                f'<navMap>{render(toc)}</navMap></ncx>\n')
+
+    def render_opf(self, toc: List[TocEntry]):
+        modified = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        manifest = []
+        for uid, href, media_type, properties in self.manifest:
+            extra = f' properties="{properties}"' if properties else ''
+            manifest.append(f'<item href="{escape(href)}" id="{uid}" media-type="{media_type}"{extra}/>')
+        manifest = ''.join(manifest)
+        spine = []
+
+        def walk(entries):
+            for entry in entries:
+                if entry.href in self.pages:
+                    spine.append(f'<itemref idref="{self.pages[entry.href]}"/>')
+                walk(entry.children)
+
+        walk(toc)
+        spine = '<itemref idref="nav"/>' + ''.join(spine)
+        return ("<?xml version='1.0' encoding='utf-8'?>\n"
+                '<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0">'
+                '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                f'<meta property="dcterms:modified">{modified}</meta>'
+                f'<dc:identifier id="id">{escape(self.identifier)}</dc:identifier>'
+                f'<dc:title>{escape(self.title)}</dc:title>'
+                f'<dc:language>{self.lang}</dc:language>'
+                f'<dc:creator id="creator">{escape(self.author)}</dc:creator>'
+                f'<dc:description>{escape(self.description)}</dc:description>'
+                f'</metadata><manifest>{manifest}</manifest>'
+                f'<spine toc="ncx">{spine}</spine></package>\n')
+
+    def finish(self, toc: List[TocEntry]):
+        self.write_item('ncx', 'toc.ncx', 'application/x-dtbncx+xml', self.render_ncx(toc))
+        self.write_item('nav', 'nav.xhtml', 'application/xhtml+xml', self.render_nav(toc), 'nav')
+        self.zip.writestr('EPUB/content.opf', self.render_opf(toc))
@@ -0,0 +1,49 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import time
+
+# Libraries whose share of the run is reported separately, matched against the file or the
+# name of C functions as cProfile reports them
+libraries = {
+    "BeautifulSoup": ("bs4",),
+    "lxml": ("lxml",),
+    "Janome": ("janome",),
+    "zstd": ("zstandard", "zstd"),
+    "sqlite": ("sqlite3",),
+}
+
+
+def library_totals(stats: pstats.Stats):
+    totals = dict.fromkeys(libraries, 0.0)
+    for (file, _, name), (_, _, tottime, _, _) in stats.stats.items():
+        where = file if file != "~" else name
+        for library, needles in libraries.items():
+            if any(needle in where for needle in needles):
+                totals[library] += tottime
+                break
+    return totals
+
+
+@contextlib.contextmanager
+def profiled(command: str, folder="profile", top=25):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{command}-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+        profiler.dump_stats(path)
+
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+        print(output.getvalue())
+        print(f"Total {stats.total_tt:.3f}s in this process, worker processes are not included.")
+        for library, total in library_totals(stats).items():
+            print(f"  {library:<14}{total:>10.3f}s {total / stats.total_tt if stats.total_tt else 0:>7.1%}")
+        print(f"Profile written to {path}")
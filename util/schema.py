@@ -0,0 +1,112 @@
+import sqlite3
+
+# Each migration is applied in one transaction and bumps PRAGMA user_version by one.
+# Version 1 is the original schema, so databases created before versioning migrate from 0 as well.
+migrations = [
+    [
+        """CREATE TABLE IF NOT EXISTS book(
+            id INTEGER PRIMARY KEY,
+            source_id TEXT,
+            source TEXT,
+            title TEXT,
+            author TEXT,
+            description TEXT,
+            old_data TEXT,
+            menu BLOB -- pickle
+        )""",
+        """CREATE INDEX IF NOT EXISTS book_id ON book(source_id, source)""",
+        """CREATE TABLE IF NOT EXISTS episode(
+            id INTEGER PRIMARY KEY,
+            book_id INTEGER,
+            source_id TEXT,
+            title TEXT,
+            content BLOB,
+            version INTEGER, --date
+            creation INTEGER, --date
+            latest INTEGER,  --bool
+            FOREIGN KEY(book_id) REFERENCES book(id)
+        )""",
+        """CREATE INDEX IF NOT EXISTS episode_book ON episode(book_id) WHERE (latest == TRUE)""",
+        """CREATE TABLE IF NOT EXISTS episode_ruby(
+            id INTEGER PRIMARY KEY,
+            book_id INTEGER,
+            source_id TEXT,
+            title TEXT,
+            content BLOB,
+            version INTEGER, --date
+            creation INTEGER, --date
+            latest INTEGER,  --bool
+            FOREIGN KEY(book_id) REFERENCES book(id)
+        )""",
+        """CREATE INDEX IF NOT EXISTS episode_ruby_book ON episode_ruby(book_id) WHERE (latest == TRUE)""",
+    ],
+    [
+        """CREATE INDEX IF NOT EXISTS episode_source ON episode(book_id, source_id, latest)""",
+        """CREATE INDEX IF NOT EXISTS episode_ruby_source ON episode_ruby(book_id, source_id, latest)""",
+    ],
+    [
+        """CREATE TABLE IF NOT EXISTS ruby_cache(
+            book_id INTEGER,
+            surface TEXT,
+            reading TEXT,
+            segments TEXT, -- json
+            PRIMARY KEY(book_id, surface, reading),
+            FOREIGN KEY(book_id) REFERENCES book(id)
+        )""",
+    ],
+    [
+        """CREATE TABLE IF NOT EXISTS compress_dict(
+            version INTEGER PRIMARY KEY,
+            dict_id INTEGER UNIQUE, -- zstd dictionary id, as written in frame headers
+            category TEXT,
+            data BLOB
+        )""",
+    ],
+    [
+        """ALTER TABLE episode ADD COLUMN compression INTEGER""",
+        """ALTER TABLE episode_ruby ADD COLUMN compression INTEGER""",
+        """UPDATE episode SET compression = 18""",
+        """UPDATE episode_ruby SET compression = 18""",
+    ],
+    [
+        """ALTER TABLE episode ADD COLUMN digest BLOB""",
+        """ALTER TABLE episode ADD COLUMN delta_base INTEGER""",
+        """ALTER TABLE episode_ruby ADD COLUMN digest BLOB""",
+        """ALTER TABLE episode_ruby ADD COLUMN delta_base INTEGER""",
+    ],
+    [
+        """ALTER TABLE book ADD COLUMN freshness TEXT""",
+    ],
+    [
+        # When the stored menu was first partly reused instead of loaded in full, NULL after a full load
+        """ALTER TABLE book ADD COLUMN partial_menu_since INTEGER""",
+    ],
+]
+
+latest_version = len(migrations)
+
+pragmas = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -65536",
+]
+
+
+def schema_version(db: sqlite3.Connection) -> int:
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db: sqlite3.Connection) -> int:
+    version = schema_version(db)
+    for version in range(version, latest_version):
+        db.execute("BEGIN")
+        try:
+            for statement in migrations[version]:
+                db.execute(statement)
+            db.execute(f"PRAGMA user_version = {version + 1}")
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+    return schema_version(db)